@@ -1,12 +1,20 @@
 # app.py (v1.9.2 - The Final Fix for All Features)
 
-import os
+import io
+import csv
 import json
-from flask import Flask, request, jsonify, render_template, send_from_directory
-import simulation_core as core
-from datetime import datetime
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderUnavailable
+import time
+from flask import Flask, Response, g, request, jsonify, render_template, send_from_directory, stream_with_context, url_for
+import jobs
+import result_cache
+import pipeline
+import batch
+import ensemble
+import export
+import graph_payload
+import geocoding
+import metrics
+import solar_geometry
 
 # --- Multilingual Comment Functions (The correct, final versions) ---
 def _generate_water_comment_v3(water_savings_percent, et_open_mm, et_agri_mm, lang='en'):
@@ -180,8 +188,35 @@ app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['LANGUAGES_FOLDER'] = 'languages'
 
 
-# --- [THE FIX IS HERE] ---
-# Restoring the full, correct code for the get_location_name function
+# --- [MODIFIED v1.16] ---
+# Instrumentation (metrics.py): every response gets a Server-Timing header with the time of each stage
+# it ran, latencies go to the /metrics histograms, and a slow simulation can be profiled (opt-in).
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    g.server_timing = {}
+    g.mode = 'none'
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def _record_request_timing(response):
+    elapsed = time.perf_counter() - g.request_start
+    response.headers['Server-Timing'] = metrics.server_timing_header(dict(g.server_timing, total=elapsed))
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code, mode=g.mode)
+    return response
+
+
+@app.teardown_request
+def _finish_request(exception=None):
+    if 'request_start' in g:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+
+
+# --- [MODIFIED v1.14] ---
+# Reverse geocoding goes through geocoding.py: one shared client, a persisted grid-cell cache,
+# coalesced identical lookups and a rate limit on the calls to the backend.
 @app.route('/get_location_name', methods=['POST'])
 def get_location_name():
     try:
@@ -189,18 +224,13 @@ def get_location_name():
         lat = data.get('lat')
         lon = data.get('lon')
 
-        if not lat or not lon:
+        if lat is None or lon is None or lat == '' or lon == '':
             return jsonify({'error': 'Latitude and Longitude are required.'}), 400
 
-        geolocator = Nominatim(user_agent="agrivoltaic_app_final_v1.3")
-        location = geolocator.reverse(f"{lat}, {lon}", exactly_one=True, timeout=10)
+        location_name = geocoding.default_geocoder().reverse(float(lat), float(lon))
+        return jsonify({'location_name': location_name or 'Location name not found.'})
 
-        if location:
-            return jsonify({'location_name': location.address})
-        else:
-            return jsonify({'location_name': 'Location name not found.'})
-
-    except GeocoderUnavailable:
+    except geocoding.GeocoderUnavailable:
         return jsonify({'error': 'Geocoding service is unavailable. Please try again later.'}), 503
     except Exception as e:
         print(f"An error occurred in get_location_name: {e}")
@@ -212,46 +242,136 @@ def index():
     return render_template('index.html')
 
 
+# --- [MODIFIED v1.10] ---
+# The simulation itself, shared by the blocking /simulate and the job API.
+# Returns (body, status_code); `progress` receives per-stage / per-pitch updates.
+def _mode_label(params):
+    # Metric label: any mode but Optimization is simulated as Custom, and the label set must stay bounded
+    return 'Optimization' if params.get('mode') == 'Optimization' else 'Custom'
+
+
+def _run_simulation(params, progress=None):
+    mode = _mode_label(params)
+    metrics.SIMULATIONS_IN_FLIGHT.inc(mode=mode)
+    try:
+        with metrics.collect_timings(mode) as timings, metrics.profile_if_slow(f"simulate_{mode}"):
+            body, status_code = _simulate(params, progress)
+    finally:
+        metrics.SIMULATIONS_IN_FLIGHT.dec(mode=mode)
+    if status_code == 200:
+        body['timings'] = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+    return body, status_code
+
+
+def _simulate(params, progress=None):
+    mode = params['mode']
+    custom_pitch = params.get('custom_pitch')
+
+    if mode != 'Optimization' and (not custom_pitch or custom_pitch <= 0):
+        return {'error': 'Invalid custom pitch value.'}, 400
+
+    # [MODIFIED v1.12] The simulation runs as a graph of memoized stages (pipeline.py), so a what-if edit
+    # only recomputes the stages downstream of what changed. The numbers also come from the result
+    # cache when the physics inputs were seen before; the comments depend on crop and language only.
+    physics_key = result_cache.physics_key(params)
+    cached = result_cache.default_cache.get(physics_key)
+    provided = {'summary': (cached['results'], cached['graph_data'])} if cached is not None else None
+    try:
+        outputs, stage_report = simulation_pipeline.run(pipeline.pipeline_params(params), ['summary', 'comments'], progress, provided)
+    except pipeline.StageFailed as e:
+        return {'error': str(e)}, 500
+
+    results, graph_data = outputs['summary']
+    if cached is None:
+        # Re-keyed after the run: a first fetch of the site's weather gives the key its weather version
+        result_cache.default_cache.put(result_cache.physics_key(params), {'results': results, 'graph_data': graph_data})
+
+    return {
+        'results': results,
+        'graph_data': graph_data,
+        'analysis_comments': outputs['comments'],
+        'stage_report': stage_report
+    }, 200
+
+
+def _stage_comments(inputs, params, progress):
+    results, _ = inputs['summary']
+    crop_params, lang = params['crop_params'], params['lang']
+    water_savings_value = results['water_savings_percent'] if params['mode'] == 'Optimization' else results['water_savings']
+
+    analysis_comments = []
+    analysis_comments.append(_generate_water_comment_v3(water_savings_value, results['et_open'], results['et_agri'], lang))
+    analysis_comments.append(_generate_temp_comment_v4(results['peak_temp_agri'], results['peak_temp_open'], crop_params, lang))
+    analysis_comments.append(_generate_dli_comment_v3(results['dli_agri'], results['dli_open'], results['peak_temp_open'], crop_params, lang))
+    return analysis_comments
+
+
+simulation_pipeline = pipeline.build_simulation_pipeline()
+simulation_pipeline.add_stage('comments', _stage_comments, ('crop_params', 'lang', 'mode'), ['summary'], cache_size=256)
+
+
+job_manager = jobs.JobManager(_run_simulation)
+
+
+def _compact_requested():
+    # [MODIFIED v1.13] ?graph_format=compact: float32 series and start+step labels (graph_payload.py)
+    return request.args.get('graph_format') == 'compact'
+
+
+def _response_etag(params):
+    etag = result_cache.response_etag(params)
+    return etag + '-compact' if _compact_requested() else etag
+
+
+def _invalid_parameters(params):
+    # Checked before anything (cache key, ETag, job) is derived from the payload
+    try:
+        pipeline.pipeline_params(params)
+    except pipeline.InvalidParameters as e:
+        return jsonify({'error': str(e)}), 400
+    return None
+
+
+def _not_modified(params):
+    # Cheap revalidation: the ETag is derived from the request, and honoured only while the result is cached
+    etag = _response_etag(params)
+    if request.if_none_match.contains_weak(etag) and result_cache.default_cache.contains(result_cache.physics_key(params)):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+
+def _simulation_response(params, body, status_code):
+    g.mode = _mode_label(params)
+    if status_code != 200:
+        return jsonify(body), status_code
+    content_encoding = graph_payload.negotiate_encoding(request.accept_encodings)
+    payload, content_encoding, stats = graph_payload.encode_body(body, _compact_requested(), content_encoding)
+    g.server_timing = {stage: milliseconds / 1000 for stage, milliseconds in body.get('timings', {}).items()}
+    g.server_timing.update(encode=stats['encode_ms'] / 1000, compress=stats['compress_ms'] / 1000)
+    response = app.response_class(payload, status=status_code, mimetype='application/json')
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['X-Payload-Stats'] = (f"mode={stats['mode']}; json_bytes={stats['json_bytes']}; sent_bytes={stats['sent_bytes']}; "
+                                           f"encode_ms={stats['encode_ms']:.2f}; compress_ms={stats['compress_ms']:.2f}")
+    response.set_etag(_response_etag(params), weak=True)
+    return response
+
+
 @app.route('/simulate', methods=['POST'])
 def simulate():
     try:
         params = request.json
-        sys_params = params['sys_params']
-        crop_params = params['crop_params']
-        mode = params['mode']
-        custom_pitch = params.get('custom_pitch')
-        lang = params.get('lang', 'en')
-
-        df_env = core.fetch_pvgis_data(sys_params['latitude'], sys_params['longitude'], sys_params['altitude'])
-        if df_env is None:
-            return jsonify({'error': "Error fetching data from PVGIS."}), 500
-        
-        results = {}
-        graph_data = {}
-        analysis_comments = []
-
-        if mode == 'Optimization':
-            opt_results, graph_data = core.run_optimization_analysis(df_env, sys_params, crop_params)
-            best_pitch = opt_results['pitch']
-            temp_results, _ = core.run_single_pitch_analysis(df_env, sys_params, crop_params, best_pitch)
-            results.update(temp_results)
-            results.update(opt_results)
-            water_savings_value = results['water_savings_percent']
-        else:
-            if not custom_pitch or custom_pitch <= 0:
-                return jsonify({'error': 'Invalid custom pitch value.'}), 400
-            results, graph_data = core.run_single_pitch_analysis(df_env, sys_params, crop_params, custom_pitch)
-            water_savings_value = results['water_savings']
-        
-        analysis_comments.append(_generate_water_comment_v3(water_savings_value, results['et_open'], results['et_agri'], lang))
-        analysis_comments.append(_generate_temp_comment_v4(results['peak_temp_agri'], results['peak_temp_open'], crop_params, lang))
-        analysis_comments.append(_generate_dli_comment_v3(results['dli_agri'], results['dli_open'], results['peak_temp_open'], crop_params, lang))
-
-        return jsonify({
-            'results': results,
-            'graph_data': graph_data,
-            'analysis_comments': analysis_comments
-        })
+        invalid = _invalid_parameters(params)
+        if invalid is not None:
+            return invalid
+        not_modified = _not_modified(params)
+        if not_modified is not None:
+            return not_modified
+        body, status_code = _run_simulation(params)
+        return _simulation_response(params, body, status_code)
 
     except Exception as e:
         import traceback
@@ -260,6 +380,224 @@ def simulate():
         return jsonify({'error': str(e)}), 500
 
 
+# --- Job API: non-blocking /simulate ---
+def _job_links(handle):
+    # A deduplicated submitter sees its own handle as the job id, so its DELETE only withdraws itself
+    return {
+        'job_id': handle,
+        'status_url': url_for('get_simulation_job', job_id=handle),
+        'events_url': url_for('stream_simulation_job_events', job_id=handle),
+        'result_url': url_for('get_simulation_job_result', job_id=handle)
+    }
+
+
+@app.route('/simulate/jobs', methods=['POST'])
+def submit_simulation_job():
+    params = request.json
+    if not params or not all(key in params for key in ('sys_params', 'crop_params', 'mode')):
+        return jsonify({'error': 'sys_params, crop_params and mode are required.'}), 400
+    invalid = _invalid_parameters(params)
+    if invalid is not None:
+        return invalid
+    not_modified = _not_modified(params)
+    if not_modified is not None:
+        return not_modified
+    try:
+        job, handle, deduplicated = job_manager.submit(params)
+    except jobs.QueueFull as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': '5'}
+
+    body = _job_links(handle)
+    body.update(status=job.status, deduplicated=deduplicated)
+    return jsonify(body), 202, {'Location': body['status_url']}
+
+
+@app.route('/simulate/jobs/<job_id>', methods=['GET'])
+def get_simulation_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job.'}), 404
+    body = job.snapshot()
+    body.update(_job_links(job_id))
+    return jsonify(body)
+
+
+@app.route('/simulate/jobs/<job_id>', methods=['DELETE'])
+def cancel_simulation_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job.'}), 404
+    return jsonify(dict(job.snapshot(), job_id=job_id)), 202
+
+
+@app.route('/simulate/jobs/<job_id>/result', methods=['GET'])
+def get_simulation_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job.'}), 404
+    if job.status in jobs.ACTIVE_STATUSES:
+        return jsonify(job.snapshot()), 202
+    if job.status == 'cancelled':
+        return jsonify({'error': 'The simulation was cancelled.'}), 409
+    return _simulation_response(job.params, job.result, job.status_code)
+
+
+@app.route('/simulate/jobs/<job_id>/events', methods=['GET'])
+def stream_simulation_job_events(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job.'}), 404
+
+    # A malformed Last-Event-ID replays the stream from the start
+    try:
+        last_seq = max(0, int(request.headers.get('Last-Event-ID', 0) or 0))
+    except ValueError:
+        last_seq = 0
+
+    def generate():
+        seq = last_seq
+        while True:
+            events = job.events_after(seq, timeout=15)
+            if not events:
+                # Finished and nothing newer than what the client has (e.g. it reconnected after 'done')
+                if job.status not in jobs.ACTIVE_STATUSES:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                seq = event['seq']
+                yield f"id: {seq}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                if event['type'] == 'done':
+                    return
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- Batch API: many sites, one summary row streamed back per site as soon as it is done ---
+BATCH_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+@app.route('/simulate/batch', methods=['POST'])
+def simulate_batch():
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(list(BATCH_MIMETYPES.values()), default=BATCH_MIMETYPES['ndjson'])
+        fmt = next(name for name, mimetype in BATCH_MIMETYPES.items() if mimetype == best)
+    if fmt not in BATCH_MIMETYPES:
+        return jsonify({'error': f"Unknown format: {fmt}."}), 400
+
+    try:
+        input_format = 'csv' if request.mimetype == 'text/csv' else 'json'
+        records, defaults = batch.read_sites(io.StringIO(request.get_data(as_text=True)), input_format)
+        # Query parameters (?panel_width=2&mode=Custom&custom_pitch=6) fill in what the sites leave out
+        defaults = dict(defaults, **{name: value for name, value in request.args.items() if name != 'format'})
+    except (ValueError, csv.Error) as e:
+        return jsonify({'error': f"Could not read the site list: {e}"}), 400
+    if not records:
+        return jsonify({'error': 'The site list is empty.'}), 400
+    if len(records) > batch.MAX_BATCH_SITES:
+        return jsonify({'error': f"At most {batch.MAX_BATCH_SITES} sites per batch."}), 413
+
+    rows = batch.run_batch(records, defaults)
+    return Response(stream_with_context(batch.format_rows(rows, fmt)), mimetype=BATCH_MIMETYPES[fmt],
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- Ensemble: one site over many weather years, one NDJSON line per year, then the distributions ---
+@app.route('/simulate/ensemble', methods=['POST'])
+def simulate_ensemble():
+    g.mode = 'Ensemble'
+    # ?years=2005-2020&source=synthetic&statistic=p10 override the body
+    request_params = dict(request.get_json(silent=True) or {}, **request.args)
+    try:
+        events = ensemble.run_ensemble(downloads=False, **ensemble.ensemble_params(request_params))
+    except ensemble.EnsembleError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        metrics.SIMULATIONS_IN_FLIGHT.inc(mode='Ensemble')
+        try:
+            for event in events:
+                yield json.dumps(event) + '\n'
+        finally:
+            metrics.SIMULATIONS_IN_FLIGHT.dec(mode='Ensemble')
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- Export: the full hourly df_sim / daily ET series, streamed chunk by chunk ---
+def _pitch_simulation(params):
+    """Simulation outputs (df_sim, daily ET) of the pitch a /simulate payload resolves to; Optimization exports the optimum."""
+    simulation_params = pipeline.pipeline_params(params)
+    if simulation_params['mode'] == 'Optimization':
+        cached = result_cache.default_cache.get(result_cache.physics_key(params))
+        if cached is not None:
+            optimal_pitch = cached['results']['pitch']
+        else:
+            outputs, _ = simulation_pipeline.run(simulation_params, ['summary'])
+            optimal_pitch = outputs['summary'][0]['pitch']
+        simulation_params.update(mode='Custom', pitch=float(optimal_pitch))
+    outputs, _ = simulation_pipeline.run(simulation_params, ['simulation'])
+    return outputs['simulation'], simulation_params['pitch']
+
+
+@app.route('/simulate/export', methods=['POST'])
+def export_simulation_series():
+    params = request.json
+    if not params or not all(key in params for key in ('sys_params', 'mode')):
+        return jsonify({'error': 'sys_params and mode are required.'}), 400
+    custom_pitch = params.get('custom_pitch')
+    if params['mode'] != 'Optimization' and (not isinstance(custom_pitch, (int, float)) or custom_pitch <= 0):
+        return jsonify({'error': 'Invalid custom pitch value.'}), 400
+    params.setdefault('crop_params', {})
+
+    series = request.args.get('series', 'hourly')
+    fmt = request.args.get('format')
+    if fmt is None:
+        best = request.accept_mimetypes.best_match(list(export.FORMATS.values()), default=export.FORMATS['csv'])
+        fmt = next(name for name, mimetype in export.FORMATS.items() if mimetype == best)
+    columns = [column for column in request.args.get('columns', '').split(',') if column]
+
+    try:
+        simulation_outputs, pitch = _pitch_simulation(params)
+        frame = export.select(export.series_frame(simulation_outputs, series), series, columns,
+                              request.args.get('start'), request.args.get('end'))
+        chunks = export.iter_export(frame, fmt)
+    except pipeline.StageFailed as e:
+        return jsonify({'error': str(e)}), 500
+    except (export.ExportError, pipeline.InvalidParameters) as e:
+        return jsonify({'error': str(e)}), 400
+
+    extension = {'csv': 'csv', 'ndjson': 'ndjson', 'columnar': 'agvcol'}[fmt]
+    headers = {'Content-Disposition': f'attachment; filename="agrivoltaic_{series}_pitch_{pitch:g}m.{extension}"',
+               'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(chunks), mimetype=export.FORMATS[fmt], headers=headers)
+
+
+def _collect_component_metrics():
+    cache_info = result_cache.default_cache.info()
+    metrics.set_cache_stats('result', sum(cache_info['hits'].values()), cache_info['misses'])
+    for cache, info in solar_geometry.cache_info().items():
+        metrics.set_cache_stats(cache, info['hits'], info['misses'])
+    # Only reported once a lookup built the geocoder; /metrics must not create it
+    geocoder = geocoding._default_geocoder
+    if geocoder is not None:
+        info = geocoder.info()
+        metrics.set_cache_stats('geocoding', info['hits'] + info['coalesced'], info['misses'])
+        metrics.GEOCODER_ERRORS.set(info['errors'], backend=info['backend'])
+    for status, count in job_manager.stats().items():
+        metrics.JOBS.set(count, status=status)
+
+
+metrics.registry.add_collector(_collect_component_metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/languages/<lang_code>.json')
 def get_language(lang_code):
     return send_from_directory(app.config['LANGUAGES_FOLDER'], f"{lang_code}.json")
@@ -0,0 +1,276 @@
+# batch.py (v1.0)
+# Simulation dyal bzzaf dyal les sites f mrra: l'weather kayjiw b fetcher m7doud (threads), o simulations
+# kaydouro f process pool 3la ga3 les cores. Kol site kayrj3 row wa7ed dyal resume mli kaykemmel.
+#
+# CLI:  python batch.py sites.csv --format csv --output results.csv
+#       python batch.py sites.json --mode Custom --custom-pitch 6 --workers 4
+
+import io
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import simulation_core as core
+import env_arrays
+import optimizer
+
+FETCH_CONCURRENCY = int(os.environ.get('AGRIVOLTAIC_BATCH_FETCH_CONCURRENCY', 4))
+MAX_BATCH_SITES = int(os.environ.get('AGRIVOLTAIC_MAX_BATCH_SITES', 500))
+
+SYS_PARAM_NAMES = ('latitude', 'longitude', 'altitude', 'panel_width', 'panel_length', 'pivot_height', 'max_tilt', 'axis_azimuth')
+SUMMARY_COLUMNS = ('site_id', 'status', 'error', 'latitude', 'longitude', 'altitude', 'mode', 'pitch', 'water_savings',
+                   'et_open', 'et_agri', 'dli_open', 'dli_agri', 'peak_temp_open', 'peak_temp_agri', 'runtime_s')
+FORMATS = ('ndjson', 'csv')
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise BatchError(f"Not a number: {value!r}.")
+    return None if np.isnan(value) else value
+
+
+def normalize_site(site, defaults=None, index=0):
+    """Turns one input record into a simulation request; a flat record (CSV row) or a /simulate-like one both work.
+
+    `defaults` supplies whatever the record leaves out (shared panel geometry, mode, ...).
+    Raises BatchError when the site cannot be simulated.
+    """
+    defaults = defaults or {}
+    sys_params = dict(defaults.get('sys_params', {}))
+    sys_params.update({name: defaults[name] for name in SYS_PARAM_NAMES if name in defaults})
+    sys_params.update(site.get('sys_params', {}))
+    sys_params.update({name: site[name] for name in SYS_PARAM_NAMES if name in site})
+    sys_params = {name: _number(value) for name, value in sys_params.items()}
+    sys_params['altitude'] = sys_params.get('altitude') or 0.0
+
+    missing = [name for name in SYS_PARAM_NAMES if sys_params.get(name) is None]
+    if missing:
+        raise BatchError(f"Missing parameters: {', '.join(missing)}.")
+
+    def setting(name, fallback=None):
+        value = site.get(name)
+        return defaults.get(name, fallback) if value is None or value == '' else value
+
+    mode = 'Optimization' if setting('mode', 'Optimization') == 'Optimization' else 'Custom'
+    custom_pitch = _number(setting('custom_pitch'))
+    if mode != 'Optimization' and (not custom_pitch or custom_pitch <= 0):
+        raise BatchError('Invalid custom pitch value.')
+    try:
+        ground_resolution, shading_method = core.shading_options(_number(setting('ground_resolution', core.DEFAULT_GROUND_RESOLUTION)),
+                                                                 setting('shading_method', 'raster'))
+        pitch_tolerance = optimizer.pitch_tolerance(_number(setting('pitch_tolerance')))
+    except ValueError as e:
+        raise BatchError(str(e))
+
+    return {
+        'site_id': str(setting('site_id', site.get('name', index))),
+        'sys_params': sys_params,
+        'mode': mode,
+        'custom_pitch': custom_pitch,
+        'pitch_tolerance': pitch_tolerance,
+        'ground_resolution': ground_resolution,
+        'shading_method': shading_method
+    }
+
+
+def read_sites(source, fmt=None):
+    """Parses a CSV (one site per row) or JSON (list, or {'sites': [...], 'defaults': {...}}) site list.
+
+    `source` is a path or a file-like object. Returns (records, defaults).
+    """
+    if isinstance(source, str):
+        fmt = fmt or ('json' if source.endswith('.json') else 'csv')
+        with open(source, newline='') as f:
+            return read_sites(f, fmt)
+    if fmt == 'json':
+        data = json.load(source)
+        records, defaults = (data.get('sites', []), data.get('defaults', {})) if isinstance(data, dict) else (data, {})
+    else:
+        records, defaults = list(csv.DictReader(source)), {}
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records) or not isinstance(defaults, dict):
+        raise BatchError('Expected a list of site objects.')
+    return records, defaults
+
+
+def _summary_row(site, status, results=None, pitch=None, error=None, runtime_s=None):
+    row = dict.fromkeys(SUMMARY_COLUMNS)
+    row.update(site_id=site['site_id'], status=status, error=error, mode=site.get('mode'), pitch=pitch, runtime_s=runtime_s)
+    row.update({name: site.get('sys_params', {}).get(name) for name in ('latitude', 'longitude', 'altitude')})
+    if results is not None:
+        row.update({name: float(results[name]) for name in SUMMARY_COLUMNS if name in results})
+    return row
+
+
+def simulate_site(site, df_env):
+    """Physics-only summary of one site (no graphs, no comments), as a SUMMARY_COLUMNS row."""
+    start_time = time.perf_counter()
+    sys_params = site['sys_params']
+    if site['mode'] == 'Optimization' and site['pitch_tolerance']:
+        report = optimizer.optimize_pitch(df_env, sys_params, tol=site['pitch_tolerance'],
+                                          ground_resolution=site['ground_resolution'], shading_method=site['shading_method'])
+        pitch, simulation_outputs = report['best_layout']['pitch'], report['simulation_outputs']
+    elif site['mode'] == 'Optimization':
+        pitch_options = np.arange(4.0, 10.5, 0.5)
+        sweep = core._simulate_pitches(df_env, sys_params, pitch_options, site['ground_resolution'], site['shading_method'])
+        optimal_index = int(np.argmax(sweep['water_savings']))
+        pitch, simulation_outputs = pitch_options[optimal_index], core._pitch_outputs(df_env, sweep, optimal_index)
+    else:
+        pitch = site['custom_pitch']
+        simulation_outputs = core._run_shading_and_et_simulation(df_env, sys_params, pitch, site['ground_resolution'], site['shading_method'])
+    results = core._pitch_results(simulation_outputs)
+    return _summary_row(site, 'ok', results, float(pitch), runtime_s=time.perf_counter() - start_time)
+
+
+def _fetch_weather(site):
+    sys_params = site['sys_params']
+    return core.fetch_env(sys_params['latitude'], sys_params['longitude'], sys_params['altitude'])
+
+
+def _simulate_shared(site, shared_name):
+    # Attached in the task: a segment released by an abandoned batch fails this site, not the shared pool
+    return simulate_site(site, env_arrays.attach(shared_name))
+
+
+def run_batch(records, defaults=None, n_workers=None, fetch_concurrency=FETCH_CONCURRENCY):
+    """Simulates every site and yields its summary row as soon as it is done (completion order).
+
+    Weather is fetched by `fetch_concurrency` threads, simulations run on the process pool shared with
+    the other requests (optimizer.shared_pool), whose workers read each site's weather from shared
+    memory rather than from a pickled copy.
+    At most a few sites per worker are held in memory at once, however long the list is.
+    A site that fails only produces a row with status 'error'.
+    """
+    n_workers = optimizer.default_worker_count() if n_workers is None else max(1, int(n_workers))
+    max_in_flight = fetch_concurrency + 2 * n_workers
+    records = iter(enumerate(records))
+    pending = {}
+    # Segments this generator created, released as soon as their site is simulated
+    shared = {}
+
+    fetcher = ThreadPoolExecutor(max_workers=fetch_concurrency, thread_name_prefix='batch-fetch')
+    # One worker: simulate in this process rather than paying for a pool
+    simulator = optimizer.shared_pool(n_workers) if n_workers > 1 else None
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                index, record = next(records, (None, None))
+                if record is None:
+                    break
+                try:
+                    site = normalize_site(record, defaults, index)
+                except BatchError as e:
+                    yield _summary_row({'site_id': str(record.get('site_id', record.get('name', index)))}, 'error', error=str(e))
+                    continue
+                pending[fetcher.submit(_fetch_weather, site)] = ('fetch', site)
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, site = pending.pop(future)
+                if future in shared:
+                    env_arrays.release(shared.pop(future))
+                try:
+                    value = future.result()
+                except Exception as e:
+                    yield _summary_row(site, 'error', error=f"{type(e).__name__}: {e}")
+                    continue
+                if stage == 'simulate':
+                    yield value
+                elif value is None:
+                    yield _summary_row(site, 'error', error="Error fetching data from PVGIS.")
+                elif simulator is None:
+                    try:
+                        yield simulate_site(site, value)
+                    except Exception as e:
+                        yield _summary_row(site, 'error', error=f"{type(e).__name__}: {e}")
+                else:
+                    env = value if value.shared_name is not None else env_arrays.share(value)
+                    future = simulator.submit(_simulate_shared, site, env.shared_name)
+                    pending[future] = ('simulate', site)
+                    if env is not value:
+                        shared[future] = env
+    finally:
+        # Reached on normal exit and when the consumer stops early (e.g. client disconnect)
+        for future in pending:
+            future.cancel()
+        for env in shared.values():
+            env_arrays.release(env)
+        fetcher.shutdown(wait=False, cancel_futures=True)
+
+
+def format_rows(rows, fmt='ndjson'):
+    """Serializes rows one line at a time, so the output can be streamed."""
+    if fmt not in FORMATS:
+        raise BatchError(f"Unknown format: {fmt}.")
+    if fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(row) + '\n'
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=SUMMARY_COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a list of candidate sites and stream one summary row per site.")
+    parser.add_argument('sites_file', help="CSV (one site per row) or JSON list of sites; '-' reads CSV from stdin.")
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--output', help="Output file (default: stdout).")
+    parser.add_argument('--workers', type=int, help="Simulation processes (default: all available cores).")
+    parser.add_argument('--fetch-concurrency', type=int, default=FETCH_CONCURRENCY, help="Concurrent weather downloads.")
+    parser.add_argument('--mode', choices=('Optimization', 'Custom'), help="Default mode for sites that do not set one.")
+    parser.add_argument('--custom-pitch', type=float, help="Default pitch (m) for Custom sites.")
+    parser.add_argument('--pitch-tolerance', type=float, help="Continuous pitch search tolerance for Optimization sites.")
+    for name in SYS_PARAM_NAMES[2:]:
+        parser.add_argument('--' + name.replace('_', '-'), type=float, help=f"Default {name} for sites that do not set it.")
+    args = parser.parse_args(argv)
+
+    records, defaults = read_sites(sys.stdin, 'csv') if args.sites_file == '-' else read_sites(args.sites_file)
+    defaults = dict(defaults)
+    for name in SYS_PARAM_NAMES[2:] + ('mode', 'custom_pitch', 'pitch_tolerance'):
+        if getattr(args, name) is not None:
+            defaults[name] = getattr(args, name)
+
+    failures = []
+
+    def counted(rows):
+        for row in rows:
+            if row['status'] != 'ok':
+                failures.append(row['site_id'])
+            yield row
+
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        for line in format_rows(counted(run_batch(records, defaults, args.workers, args.fetch_concurrency)), args.format):
+            output.write(line)
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if failures:
+        print(f"{len(failures)} site(s) failed: {', '.join(failures)}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
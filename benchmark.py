@@ -0,0 +1,370 @@
+# benchmark.py (v1.0)
+# Benchmarks dyal simulation_core o l'endpoints, offline 3la fixtures TMY dyal climats mkhtalfin (benchmarks/fixtures).
+# Kol stage kayt9as b wahdo (wa9t o memoire), o 'compare' kayqaren m3a baseline o kaybeyyen les regressions.
+#
+#   python benchmark.py run --output benchmarks/current.json            (--quick for a smoke run)
+#   python benchmark.py compare benchmarks/current.json                 (against the checked-in benchmarks/baseline.json)
+#   python benchmark.py fixtures --synthetic                            (rebuild the fixtures; --from-pvgis needs network)
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import pvlib
+import simulation_core as core
+import env_arrays
+import solar_geometry
+import weather_cache
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures')
+FIXTURE_YEAR = 2022
+# Reference report of the fixtures, regenerated with `run --output benchmarks/baseline.json` after intended changes
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline.json')
+
+# Sites of each climate, and the knobs of the synthetic stand-in used when PVGIS is out of reach:
+# daily clearness ~ Beta(a, b), annual mean / seasonal / diurnal temperature amplitude (°C), mean RH (%), mean wind (m/s)
+CLIMATES = {
+    'hot_arid': {'latitude': 24.71, 'longitude': 46.68, 'altitude': 610, 'clearness': (9.0, 1.5), 'temperature': (26.0, 9.5, 7.0), 'humidity': 25.0, 'wind': 3.5},
+    'mediterranean': {'latitude': 36.8, 'longitude': 10.2, 'altitude': 10, 'clearness': (4.0, 1.6), 'temperature': (18.5, 7.5, 4.5), 'humidity': 68.0, 'wind': 4.0},
+    'temperate': {'latitude': 48.85, 'longitude': 2.35, 'altitude': 35, 'clearness': (2.0, 1.8), 'temperature': (12.0, 7.0, 4.0), 'humidity': 76.0, 'wind': 3.0},
+    'tropical_humid': {'latitude': 13.75, 'longitude': 100.5, 'altitude': 5, 'clearness': (3.0, 1.8), 'temperature': (28.5, 2.0, 4.0), 'humidity': 78.0, 'wind': 2.0},
+}
+PANEL_PARAMS = {'panel_width': 2.0, 'panel_length': 4.0, 'pivot_height': 3.0, 'max_tilt': 55.0, 'axis_azimuth': 180.0}
+CROP_PARAMS = {'name': 'Tomato', 'dli_min': 15, 'dli_max': 30, 'temp_min': 18, 'temp_max': 29}
+
+DEFAULT_PITCHES = (4.0, 6.0, 10.0)
+DEFAULT_RESOLUTIONS = (0.05, 0.1, 0.2)
+DEFAULT_REPEAT = 5
+# A case regresses when its median time grows by more than this fraction and this many seconds
+TIME_THRESHOLD = 0.15
+MIN_TIME_DELTA_S = 0.002
+MEMORY_THRESHOLD = 0.20
+MIN_MEMORY_DELTA_MB = 1.0
+
+
+# --- Fixtures ---
+def fixture_path(climate):
+    return os.path.join(FIXTURES_DIR, f"{climate}.npz")
+
+
+def synthetic_tmy(climate, seed=0):
+    """A year of hourly weather shaped like fetch_pvgis_data output, from clear-sky irradiance and the climate's knobs."""
+    site = CLIMATES[climate]
+    latitude, longitude, altitude = site['latitude'], site['longitude'], site['altitude']
+    index = solar_geometry.hourly_index(FIXTURE_YEAR)
+    rng = np.random.default_rng(seed)
+
+    clearsky = pvlib.location.Location(latitude, longitude, altitude=altitude).get_clearsky(index)
+    sun_elevation, sun_azimuth = solar_geometry.solar_position(latitude, longitude, altitude, FIXTURE_YEAR)
+    clearness = np.repeat(rng.beta(*site['clearness'], len(index) // 24), 24) * rng.uniform(0.9, 1.05, len(index))
+    ghi = clearsky['ghi'].to_numpy() * np.clip(clearness, 0.05, 1.0)
+    decomposition = pvlib.irradiance.erbs(ghi, 90 - sun_elevation, index)
+
+    mean_temperature, seasonal_amplitude, diurnal_amplitude = site['temperature']
+    day_of_year = index.dayofyear.to_numpy()
+    solar_hour = (index.hour.to_numpy() + longitude / 15) % 24
+    coldest_day = 15 if latitude >= 0 else 197
+    temp_air = (mean_temperature - seasonal_amplitude * np.cos(2 * np.pi * (day_of_year - coldest_day) / 365)
+                + diurnal_amplitude * np.sin(2 * np.pi * (solar_hour - 9) / 24) + rng.normal(0, 1.0, len(index)))
+    relative_humidity = np.clip(site['humidity'] - 2.0 * (temp_air - mean_temperature) + rng.normal(0, 5, len(index)), 5, 100)
+    wind_speed = site['wind'] * rng.weibull(2.0, len(index)) / 0.886
+
+    df_env = pd.DataFrame(index=index)
+    df_env['ghi'] = ghi.round(1)
+    df_env['dhi'] = np.asarray(decomposition['dhi']).round(1)
+    df_env['dni'] = np.asarray(decomposition['dni']).round(1)
+    df_env['temp_air'] = temp_air.round(2)
+    df_env['wind_speed'] = wind_speed.round(2)
+    df_env['relative_humidity'] = relative_humidity.round(1)
+    df_env['sun_elevation'] = sun_elevation
+    df_env['sun_azimuth'] = sun_azimuth
+    return df_env.ffill().bfill()
+
+
+def build_fixtures(source='synthetic', climates=None):
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for climate in climates or CLIMATES:
+        site = CLIMATES[climate]
+        if source == 'pvgis':
+            df_env = core.fetch_pvgis_data(site['latitude'], site['longitude'], site['altitude'], offline=False)
+            if df_env is None:
+                print(f"FAILED   {climate}")
+                continue
+        else:
+            df_env = synthetic_tmy(climate)
+        weather_cache.write_frame(fixture_path(climate), df_env, compressed=True)
+        print(f"wrote    {fixture_path(climate)}")
+
+
+def load_fixture(climate):
+    df_env = weather_cache.read_frame(fixture_path(climate))
+    if df_env is None:
+        raise FileNotFoundError(f"Missing fixture {fixture_path(climate)}; run `python benchmark.py fixtures --synthetic`.")
+    return df_env
+
+
+def system_params(climate):
+    site = CLIMATES[climate]
+    return dict(PANEL_PARAMS, latitude=site['latitude'], longitude=site['longitude'], altitude=site['altitude'])
+
+
+# --- Measurement ---
+def measure(function, setup=None, repeat=DEFAULT_REPEAT):
+    """Wall time of `function()` over `repeat` runs (min / median) and its peak traced allocation.
+
+    `setup` runs untimed before each call, e.g. to clear a cache the stage would otherwise hit.
+    The allocation is measured on a separate run, since tracing slows the code down.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'min_s': min(times), 'median_s': statistics.median(times), 'repeat': repeat, 'peak_mb': peak_bytes / 1024 ** 2}
+
+
+def case_id(name, **params):
+    return name + '[' + ','.join(f"{key}={value}" for key, value in params.items()) + ']'
+
+
+def _stage_cases(climate, df_env, pitches, resolutions):
+    """(name, params, function, setup) for every stage of simulation_core on one fixture."""
+    params = system_params(climate)
+    site = (params['latitude'], params['longitude'], params['altitude'])
+    env = env_arrays.as_env(df_env)
+    sun_elevation, sun_azimuth = np.asarray(env['sun_elevation'], dtype=float), np.asarray(env['sun_azimuth'], dtype=float)
+    cases = [('solar_position', {}, lambda: solar_geometry.solar_position(*site, FIXTURE_YEAR), solar_geometry.clear_caches)]
+
+    for pitch in pitches:
+        panel_tilt = core._compute_panel_tilt(env, params, pitch)
+        cases.append(('tracking', {'pitch': pitch}, lambda pitch=pitch: core._compute_panel_tilt(env, params, pitch), solar_geometry.clear_caches))
+        shadow_start, shadow_end = core._compute_shadow_intervals(panel_tilt, sun_elevation, sun_azimuth, params, pitch)
+        for resolution in resolutions:
+            cases.append(('shading', {'pitch': pitch, 'resolution': resolution, 'method': 'raster'},
+                          lambda pitch=pitch, resolution=resolution: core._shaded_fraction(shadow_start, shadow_end, pitch, 'raster', resolution), None))
+        cases.append(('shading', {'pitch': pitch, 'method': 'analytic'},
+                      lambda pitch=pitch, start=shadow_start, end=shadow_end: core._shaded_fraction(start, end, pitch, 'analytic'), None))
+
+        simulation_outputs = core._run_shading_and_et_simulation(env, params, pitch)
+        df_sim, _, _, _, et_open, et_agri = simulation_outputs
+        cases.append(('crop_metrics', {'pitch': pitch}, lambda df_sim=df_sim: core._calculate_crop_metrics(df_sim), None))
+        graph_inputs = {'df_sim': df_sim, 'et_open': et_open, 'et_agri': et_agri}
+        cases.append(('graphs', {'pitch': pitch}, lambda graph_inputs=graph_inputs, pitch=pitch: core._prepare_graph_data(graph_inputs, pitch), None))
+
+    daily_df = core._aggregate_daily_weather(env)
+    sweep = core._simulate_pitches(env, params, np.arange(4.0, 10.5, 0.5))
+    sol_rad = env.daily(sweep['avg_ghi_agrivoltaic'] * 3600 / 1_000_000).T
+    cases.append(('daily_weather', {}, lambda: core._aggregate_daily_weather(env), None))
+    cases.append(('et', {'scenarios': sol_rad.shape[1]},
+                  lambda: core._penman_monteith_matrix(core._penman_monteith_terms(daily_df, params), sol_rad), None))
+    for resolution in resolutions:
+        cases.append(('optimization_sweep', {'resolution': resolution},
+                      lambda resolution=resolution: core.run_optimization_analysis(env, params, CROP_PARAMS, resolution), solar_geometry.clear_caches))
+    return cases
+
+
+@contextmanager
+def _offline_app(climates):
+    """The Flask app serving the fixtures as its (offline) weather cache, with no persistent result cache."""
+    import app
+    import result_cache
+    saved = weather_cache.CACHE_DIR, weather_cache.OFFLINE, result_cache.default_cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        weather_cache.CACHE_DIR, weather_cache.OFFLINE = cache_dir, True
+        for climate in climates:
+            params = system_params(climate)
+            weather_cache.store(weather_cache.site_key(params['latitude'], params['longitude'], params['altitude']), load_fixture(climate))
+        try:
+            yield app
+        finally:
+            weather_cache.CACHE_DIR, weather_cache.OFFLINE, result_cache.default_cache = saved
+
+
+def _endpoint_cases(app, climate, pitches):
+    import result_cache
+    client = app.app.test_client()
+    payloads = [('Optimization', {'mode': 'Optimization'}), ('Optimization_continuous', {'mode': 'Optimization', 'pitch_tolerance': 0.05})]
+    payloads += [('Custom', {'mode': 'Custom', 'custom_pitch': pitch}) for pitch in pitches[:1]]
+
+    def cold_start():
+        result_cache.default_cache = result_cache.ResultCache(disk_dir=None)
+        app.simulation_pipeline.clear()
+        solar_geometry.clear_caches()
+
+    cases = []
+    for label, extra in payloads:
+        body = dict({'sys_params': system_params(climate), 'crop_params': CROP_PARAMS, 'lang': 'en'}, **extra)
+
+        def post(body=body):
+            response = client.post('/simulate', json=body)
+            if response.status_code != 200:
+                raise RuntimeError(f"/simulate returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+        params = {'mode': label}
+        if 'custom_pitch' in extra:
+            params['pitch'] = extra['custom_pitch']
+        cases.append(('simulate_cold', params, post, cold_start))
+        # The result cache and the memoized stages answer the repeated request
+        cases.append(('simulate_warm', params, post, None))
+    return cases
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(climates=None, pitches=DEFAULT_PITCHES, resolutions=DEFAULT_RESOLUTIONS, repeat=DEFAULT_REPEAT, endpoints=True, log=print):
+    """Runs every case and returns the report: {'meta': ..., 'results': {case_id: measurement}}."""
+    climates = list(climates or CLIMATES)
+    report = {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'git_revision': _git_revision(),
+            'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'pvlib': pvlib.__version__,
+            'climates': climates, 'pitches': list(pitches), 'resolutions': list(resolutions), 'repeat': repeat
+        },
+        'results': {}
+    }
+
+    def record(climate, name, params, function, setup):
+        key = case_id(name, climate=climate, **params)
+        report['results'][key] = dict(measure(function, setup, repeat), stage=name, climate=climate, params=params)
+        log(f"{key:<70} {report['results'][key]['median_s'] * 1000:9.2f} ms  {report['results'][key]['peak_mb']:8.1f} MB")
+
+    for climate in climates:
+        df_env = load_fixture(climate)
+        for name, params, function, setup in _stage_cases(climate, df_env, pitches, resolutions):
+            record(climate, name, params, function, setup)
+
+    if endpoints:
+        with _offline_app(climates) as app:
+            for climate in climates:
+                for name, params, function, setup in _endpoint_cases(app, climate, pitches):
+                    record(climate, name, params, function, setup)
+    return report
+
+
+def compare(baseline, current, time_threshold=TIME_THRESHOLD, memory_threshold=MEMORY_THRESHOLD,
+            min_time_delta_s=MIN_TIME_DELTA_S, min_memory_delta_mb=MIN_MEMORY_DELTA_MB):
+    """Rows of (case, baseline ms, current ms, time ratio, baseline MB, current MB, verdict) for the common cases.
+
+    A case is a 'REGRESSION' when its median time (or peak memory) grows beyond both the relative
+    threshold and the absolute floor, which keeps sub-millisecond noise from being flagged.
+    """
+    rows = []
+    for key in sorted(set(baseline['results']) & set(current['results'])):
+        before, after = baseline['results'][key], current['results'][key]
+        time_ratio = after['median_s'] / before['median_s'] if before['median_s'] > 0 else float('inf')
+        slower = time_ratio > 1 + time_threshold and after['median_s'] - before['median_s'] > min_time_delta_s
+        bigger = (after['peak_mb'] > before['peak_mb'] * (1 + memory_threshold)
+                  and after['peak_mb'] - before['peak_mb'] > min_memory_delta_mb)
+        if slower or bigger:
+            verdict = 'REGRESSION' + (' (time)' if slower and not bigger else ' (memory)' if bigger and not slower else '')
+        elif time_ratio < 1 / (1 + time_threshold) and before['median_s'] - after['median_s'] > min_time_delta_s:
+            verdict = 'faster'
+        else:
+            verdict = 'ok'
+        rows.append((key, before['median_s'] * 1000, after['median_s'] * 1000, time_ratio, before['peak_mb'], after['peak_mb'], verdict))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the simulation stages and the /simulate endpoint.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="Run the benchmarks and write a JSON report.")
+    run_parser.add_argument('--output', help="Report path (default: print the JSON to stdout).")
+    run_parser.add_argument('--climates', help=f"Comma-separated subset of: {', '.join(CLIMATES)}.")
+    run_parser.add_argument('--pitches', help="Comma-separated pitches (m).")
+    run_parser.add_argument('--resolutions', help="Comma-separated ground resolutions (m).")
+    run_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    run_parser.add_argument('--no-endpoints', action='store_true', help="Skip the Flask end-to-end runs.")
+    run_parser.add_argument('--quick', action='store_true', help="One climate, one pitch and resolution, one repeat.")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare a report with a baseline; exit 1 on regressions.")
+    compare_parser.add_argument('reports', nargs='+', metavar='[baseline] current',
+                                help="Report to check, optionally preceded by the baseline (default: benchmarks/baseline.json).")
+    compare_parser.add_argument('--time-threshold', type=float, default=TIME_THRESHOLD)
+    compare_parser.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+    compare_parser.add_argument('--min-time-delta-ms', type=float, default=MIN_TIME_DELTA_S * 1000)
+
+    fixtures_parser = subparsers.add_parser('fixtures', help="Rebuild the TMY fixtures.")
+    source = fixtures_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--synthetic', action='store_true', help="Generate them from clear-sky irradiance (no network).")
+    source.add_argument('--from-pvgis', action='store_true', help="Download the real TMY of each climate's site.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'fixtures':
+        build_fixtures('pvgis' if args.from_pvgis else 'synthetic')
+        return 0
+
+    if args.command == 'compare':
+        if len(args.reports) > 2:
+            parser.error("compare takes at most two reports: [baseline] current")
+        baseline_path, current_path = ([BASELINE_PATH] + args.reports)[-2:]
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        with open(current_path) as f:
+            current = json.load(f)
+        for name in ('platform', 'cpu_count', 'python'):
+            if baseline['meta'].get(name) != current['meta'].get(name):
+                print(f"WARNING: {name} differs ({baseline['meta'].get(name)} vs {current['meta'].get(name)}), timings may not be comparable.")
+        rows = compare(baseline, current, args.time_threshold, args.memory_threshold, args.min_time_delta_ms / 1000)
+        print(f"{'case':<70} {'base ms':>10} {'now ms':>10} {'ratio':>7} {'base MB':>8} {'now MB':>8}  verdict")
+        for key, before_ms, after_ms, ratio, before_mb, after_mb, verdict in sorted(rows, key=lambda row: -row[3]):
+            print(f"{key:<70} {before_ms:10.2f} {after_ms:10.2f} {ratio:7.2f} {before_mb:8.1f} {after_mb:8.1f}  {verdict}")
+        for label, keys in (('only in baseline', set(baseline['results']) - set(current['results'])),
+                            ('new', set(current['results']) - set(baseline['results']))):
+            for key in sorted(keys):
+                print(f"{key:<70} ({label})")
+        regressions = [row for row in rows if row[-1].startswith('REGRESSION')]
+        print(f"{len(regressions)} regression(s) in {len(rows)} compared case(s).")
+        return 1 if regressions else 0
+
+    def floats(text, default):
+        return tuple(float(value) for value in text.split(',')) if text else default
+
+    climates = args.climates.split(',') if args.climates else None
+    pitches, resolutions, repeat = floats(args.pitches, DEFAULT_PITCHES), floats(args.resolutions, DEFAULT_RESOLUTIONS), args.repeat
+    if args.quick:
+        climates, pitches, resolutions, repeat = (climates or ['mediterranean'])[:1], pitches[1:2] or pitches, (0.1,), 1
+    unknown = [climate for climate in climates or [] if climate not in CLIMATES]
+    if unknown:
+        parser.error(f"unknown climate(s): {', '.join(unknown)}")
+
+    # Progress goes to stderr, so `run > report.json` stays valid JSON
+    report = run(climates, pitches, resolutions, repeat, endpoints=not args.no_endpoints, log=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+# ensemble.py (v1.0)
+# Mode ensemble: nafs l'simulation 3la bzzaf dyal snin dyal l'weather (machi ghir TMY), b parallel, o kol 3am
+# kayt-streama mli kaykemmel. F l'akhir: distributions (percentiles) o l'pitch l'a7san 3la statistic robust.
+# L'geometry (tracker o shading) ma katbeddelch m3a l'weather: kat7seb mrra wa7da o kat-partaga f shared memory.
+#
+# Weather years (source=):
+#   'store'      local files ENSEMBLE_DIR/<lat>_<lon>_<alt>m_<year>.npz (weather_cache format) or .csv
+#                (hourly UTC; columns: time, ghi, dhi, temp_air, wind_speed[, dni, relative_humidity])
+#   'pvgis'      the store first, then the PVGIS hourly series of the missing years, saved into the store
+#   'synthetic'  stand-in years made from the site's TMY with year-to-year and day-to-day anomalies
+#                (warm / dry spells, cloudy weeks); for offline use, not observed weather
+# Every year is put on the TMY's 8760-hour axis (29 February dropped), so all the members share the
+# sun position and the geometry. PVGIS hourly has no humidity; the TMY's is used for those years.
+#
+# CLI:  python ensemble.py request.json --years 2005-2020 --source synthetic --statistic p10
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+from concurrent.futures import as_completed
+import numpy as np
+import pandas as pd
+import pvlib
+import simulation_core as core
+import weather_cache
+import env_arrays
+import optimizer
+
+ENSEMBLE_DIR = os.environ.get('AGRIVOLTAIC_ENSEMBLE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'weather_years'))
+# PVGIS-SARAH2 covers 2005-2020
+ENSEMBLE_YEARS = os.environ.get('AGRIVOLTAIC_ENSEMBLE_YEARS', '2005-2020')
+MAX_ENSEMBLE_YEARS = int(os.environ.get('AGRIVOLTAIC_MAX_ENSEMBLE_YEARS', 50))
+DEFAULT_STATISTIC = os.environ.get('AGRIVOLTAIC_ENSEMBLE_STATISTIC', 'median')
+SOURCES = ('store', 'pvgis', 'synthetic')
+PITCH_OPTIONS = np.arange(4.0, 10.5, 0.5)
+PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+REQUIRED_COLUMNS = ('ghi', 'dhi', 'temp_air', 'wind_speed')
+METRICS = ('water_savings', 'et_open', 'et_agri', 'dli_open', 'dli_agri', 'peak_temp_open', 'peak_temp_agri')
+
+
+class EnsembleError(ValueError):
+    pass
+
+
+def parse_years(years):
+    """Years from an int, a list, or a string like '2005-2020' or '2005,2010-2012'; sorted and deduplicated."""
+    if years is None or years == '':
+        years = ENSEMBLE_YEARS
+    if isinstance(years, (int, float)) and not isinstance(years, bool):
+        years = [years]
+    elif not isinstance(years, (str, list, tuple)):
+        raise EnsembleError(f"Invalid years: {years!r}.")
+    parsed = set()
+    parts = years.split(',') if isinstance(years, str) else years
+    for part in parts:
+        try:
+            if isinstance(part, str) and '-' in part.strip()[1:]:
+                first, last = (int(value) for value in part.split('-'))
+            else:
+                first = last = int(part)
+        except (TypeError, ValueError):
+            raise EnsembleError(f"Invalid year: {part}.")
+        # Checked before expanding, so '2005-20000000' is refused without building the range
+        if first < 1900 or last > 2100:
+            raise EnsembleError("Years must be between 1900 and 2100.")
+        parsed.update(range(first, last + 1))
+        if len(parsed) > MAX_ENSEMBLE_YEARS:
+            raise EnsembleError(f"At most {MAX_ENSEMBLE_YEARS} years per ensemble.")
+    if not parsed:
+        raise EnsembleError("No years given.")
+    return sorted(parsed)
+
+
+def statistic_function(name):
+    """'mean', 'median' or 'pNN' (e.g. 'p10': the savings reached in 9 years out of 10), over the members axis."""
+    if name == 'mean':
+        return lambda values: np.mean(values, axis=0)
+    if name == 'median':
+        return lambda values: np.median(values, axis=0)
+    if isinstance(name, str) and re.fullmatch(r'p\d{1,2}', name):
+        return lambda values: np.percentile(values, int(name[1:]), axis=0)
+    raise EnsembleError(f"Unknown statistic: {name}. Expected mean, median or pNN (e.g. p10).")
+
+
+# --- Weather of one member ---
+def store_path(key, year, extension='.npz'):
+    latitude, longitude, altitude = key
+    return os.path.join(ENSEMBLE_DIR, f"{latitude:+.{weather_cache.COORD_DECIMALS}f}_{longitude:+.{weather_cache.COORD_DECIMALS}f}_{altitude}m_{year}{extension}")
+
+
+def stored_years(key, years):
+    """The years of `years` that have a file in the ensemble store."""
+    return [year for year in years if os.path.exists(store_path(key, year)) or os.path.exists(store_path(key, year, '.csv'))]
+
+
+def _read_store(key, year):
+    frame = weather_cache.read_frame(store_path(key, year))
+    if frame is not None:
+        return frame
+    path = store_path(key, year, '.csv')
+    if not os.path.exists(path):
+        return None
+    frame = pd.read_csv(path, parse_dates=['time'], index_col='time')
+    if frame.index.tz is None:
+        frame.index = frame.index.tz_localize('UTC')
+    return frame
+
+
+def _fetch_pvgis_year(key, year):
+    latitude, longitude, altitude = key
+    data = pvlib.iotools.get_pvgis_hourly(latitude, longitude, start=year, end=year, components=True,
+                                          surface_tilt=0, map_variables=True)[0]
+    # On a horizontal plane the ground-reflected part is zero
+    frame = pd.DataFrame({
+        'ghi': data['poa_direct'] + data['poa_sky_diffuse'], 'dhi': data['poa_sky_diffuse'],
+        'temp_air': data['temp_air'], 'wind_speed': data['wind_speed']
+    }, index=data.index)
+    try:
+        os.makedirs(ENSEMBLE_DIR, exist_ok=True)
+        weather_cache.write_frame(store_path(key, year), frame)
+    except OSError as e:
+        print(f"WARNING: could not write the ensemble store: {e}")
+    return frame
+
+
+def _on_tmy_axis(frame, year, tmy):
+    """Weather columns of a year's frame as arrays on the TMY's hourly axis."""
+    missing = [column for column in REQUIRED_COLUMNS if column not in frame]
+    if missing:
+        raise EnsembleError(f"{year}: missing column(s) {', '.join(missing)}.")
+    frame = frame[~((frame.index.month == 2) & (frame.index.day == 29))].ffill().bfill()
+    if len(frame) < len(tmy):
+        raise EnsembleError(f"{year}: {len(frame)} hourly values, expected {len(tmy)}.")
+    frame = frame.iloc[:len(tmy)]
+    weather = {column: frame[column].to_numpy(dtype=float) for column in REQUIRED_COLUMNS}
+    weather['relative_humidity'] = frame['relative_humidity'].to_numpy(dtype=float) if 'relative_humidity' in frame else tmy['relative_humidity']
+    if 'dni' in frame:
+        weather['dni'] = frame['dni'].to_numpy(dtype=float)
+    else:
+        sin_elevation = np.sin(np.radians(np.asarray(tmy['sun_elevation'], dtype=float)))
+        weather['dni'] = np.where(sin_elevation > 0.05, (weather['ghi'] - weather['dhi']) / np.maximum(sin_elevation, 0.05), 0.0)
+    return weather
+
+
+def _ar1(n, phi, sigma, rng):
+    # Persistent anomalies (spells of several days) with standard deviation sigma
+    noise = rng.normal(0, sigma * np.sqrt(1 - phi ** 2), n)
+    values = np.empty(n)
+    values[0] = rng.normal(0, sigma)
+    for i in range(1, n):
+        values[i] = phi * values[i - 1] + noise[i]
+    return values
+
+
+def synthetic_year(tmy, key, year):
+    """Stand-in weather year: the TMY with a yearly temperature offset and daily temperature, cloud and wind anomalies.
+
+    Deterministic for a (site, year). Warmer days get drier air; the diffuse part of the radiation is kept.
+    """
+    rng = np.random.default_rng([year, zlib.crc32(repr(key).encode())])
+    day_start = tmy.calendar()['day_start']
+    hours_per_day = np.diff(np.r_[day_start, len(tmy)])
+
+    def hourly(values):
+        return np.repeat(values, hours_per_day)
+
+    temperature_anomaly = hourly(rng.normal(0, 0.8) + _ar1(len(day_start), 0.8, 1.5, rng))
+    beam_factor = hourly(np.clip(np.exp(_ar1(len(day_start), 0.6, 0.2, rng)), 0.2, 1.3))
+    ghi, dhi = np.asarray(tmy['ghi'], dtype=float), np.asarray(tmy['dhi'], dtype=float)
+    return {
+        'ghi': dhi + (ghi - dhi) * beam_factor,
+        'dhi': dhi,
+        'dni': np.asarray(tmy['dni'], dtype=float) * beam_factor,
+        'temp_air': np.asarray(tmy['temp_air'], dtype=float) + temperature_anomaly,
+        'wind_speed': np.asarray(tmy['wind_speed'], dtype=float) * hourly(np.exp(rng.normal(0, 0.15, len(day_start)))),
+        'relative_humidity': np.clip(np.asarray(tmy['relative_humidity'], dtype=float) - 3.0 * temperature_anomaly, 5, 100)
+    }
+
+
+def load_member_weather(tmy, key, year, source):
+    """(weather arrays on the TMY axis, source actually used) of one ensemble year."""
+    if source == 'synthetic':
+        return synthetic_year(tmy, key, year), 'synthetic'
+    frame = _read_store(key, year)
+    if frame is not None:
+        return _on_tmy_axis(frame, year, tmy), 'store'
+    if source == 'store' or weather_cache.OFFLINE:
+        raise EnsembleError(f"{year}: not in the ensemble store ({store_path(key, year)}).")
+    return _on_tmy_axis(_fetch_pvgis_year(key, year), year, tmy), 'pvgis'
+
+
+# --- Members ---
+def _geometry_rows(env, n_pitches):
+    return {name: [env[f"{name}_{i}"] for i in range(n_pitches)] for name in ('panel_tilt', 'shaded_fraction')}
+
+
+def _simulate_member(state, year):
+    start_time = time.perf_counter()
+    weather, source = load_member_weather(state['env'], state['key'], year, state['source'])
+    env = state['env'].with_columns(**weather)
+    sweep = core._simulate_pitches(env, state['system_params'], None, geometry=state['geometry'])
+    per_pitch = [core._pitch_results(core._pitch_outputs(env, sweep, i)) for i in range(len(state['geometry']['pitches']))]
+    member = {'event': 'member', 'year': year, 'source': source}
+    member.update({metric: [float(results[metric]) for results in per_pitch] for metric in METRICS})
+    member['best_pitch'] = float(state['geometry']['pitches'][int(np.argmax(member['water_savings']))])
+    member['runtime_s'] = time.perf_counter() - start_time
+    return member
+
+
+def _member_state(env, pitches, system_params, key, source):
+    geometry = dict(_geometry_rows(env, len(pitches)), pitches=np.asarray(pitches))
+    return {'env': env, 'geometry': geometry, 'system_params': system_params, 'key': key, 'source': source}
+
+def _simulate_in_worker(shared_name, pitches, system_params, key, source, year):
+    # Attached here rather than unpickled with the task: a segment already released (the ensemble was
+    # abandoned) then fails this task only, instead of killing the worker and breaking the shared pool
+    env = env_arrays.attach(shared_name)
+    return _simulate_member(_member_state(env, pitches, system_params, key, source), year)
+
+
+def _distribution(values):
+    values = np.asarray(values, dtype=float)
+    distribution = {'mean': float(values.mean()), 'std': float(values.std()), 'min': float(values.min()), 'max': float(values.max())}
+    distribution.update({f"p{q}": float(np.percentile(values, q)) for q in PERCENTILES})
+    return distribution
+
+
+def summarize(members, pitches, statistic=DEFAULT_STATISTIC, dli_min=None):
+    """Robust optimum and distributions over the members (the 'member' events) that succeeded.
+
+    The optimal pitch maximizes the statistic of the water savings; with dli_min, only among the
+    pitches whose same statistic of the shaded DLI reaches it (all pitches if none does).
+    """
+    members = sorted(members, key=lambda member: member['year'])
+    values = {metric: np.array([member[metric] for member in members]) for metric in METRICS}
+    robust = statistic_function(statistic)
+    objective = robust(values['water_savings'])
+    feasible = robust(values['dli_agri']) >= dli_min if dli_min is not None else np.ones(len(pitches), dtype=bool)
+    best = int(np.argmax(np.where(feasible, objective, -np.inf))) if feasible.any() else int(np.argmax(objective))
+    best_pitches = [member['best_pitch'] for member in members]
+    return {
+        'event': 'summary', 'members': len(members), 'years': [member['year'] for member in members],
+        'statistic': statistic, 'pitches': [float(pitch) for pitch in pitches],
+        'objective_by_pitch': objective.tolist(), 'optimal_pitch': float(pitches[best]),
+        'dli_min': dli_min, 'dli_feasible': bool(feasible[best]),
+        'water_savings_by_pitch': {f"p{q}": np.percentile(values['water_savings'], q, axis=0).tolist() for q in (10, 50, 90)},
+        'distributions': {metric: _distribution(values[metric][:, best]) for metric in METRICS},
+        'by_year': {metric: values[metric][:, best].tolist() for metric in METRICS},
+        'best_pitch_frequency': {str(float(pitch)): best_pitches.count(float(pitch)) for pitch in pitches if float(pitch) in best_pitches}
+    }
+
+
+def run_ensemble(system_params, years=None, source=None, statistic=DEFAULT_STATISTIC, ground_resolution=core.DEFAULT_GROUND_RESOLUTION,
+                 shading_method='raster', n_workers=None, pitches=PITCH_OPTIONS, dli_min=None, downloads=True):
+    """Validates the request and computes the shared geometry, then returns the generator of events.
+
+    Events: one 'start' (with a 'note' when an empty store made it fall back to synthetic years),
+    one 'member' (or 'member_error') per year in completion order, and a
+    final 'summary'. Raises EnsembleError for a bad request, before anything is streamed.
+    Members run on optimizer.shared_pool(). downloads=False (the HTTP API) refuses source='pvgis':
+    the store is filled from the CLI instead, so requests never start PVGIS downloads.
+    """
+    years = parse_years(years)
+    requested_source = source
+    source = source or ('store' if weather_cache.OFFLINE or not downloads else 'pvgis')
+    if source not in SOURCES:
+        raise EnsembleError(f"Unknown source: {source}. Expected one of {', '.join(SOURCES)}.")
+    if source == 'pvgis' and not downloads:
+        raise EnsembleError("PVGIS downloads are not available here; fill the store with: python ensemble.py request.json --source pvgis")
+    statistic_function(statistic)
+    try:
+        ground_resolution, shading_method = core.shading_options(ground_resolution, shading_method)
+    except ValueError as e:
+        raise EnsembleError(str(e))
+
+    key = weather_cache.site_key(system_params['latitude'], system_params['longitude'], system_params['altitude'])
+    note = None
+    if source == 'store' and not stored_years(key, years):
+        # Every member would fail: an explicit 'store' is refused, the default falls back to synthetic years
+        if requested_source == 'store':
+            raise EnsembleError(f"None of the requested years is in the ensemble store for this site (missing: {', '.join(map(str, years))}); "
+                                "fill it with: python ensemble.py request.json --source pvgis")
+        source = 'synthetic'
+        note = "No requested year is in the ensemble store for this site; synthetic years were simulated instead."
+    tmy = core.fetch_env(*key)
+    if tmy is None:
+        raise EnsembleError("Error fetching data from PVGIS.")
+    # The weather-independent part, once for every member: tracker angles and shaded fractions
+    pitches = np.atleast_1d(np.asarray(pitches, dtype=float))
+    geometry = core._pitch_geometry(tmy, system_params, pitches, ground_resolution, shading_method)
+    env = tmy.with_columns(**{f"{name}_{i}": geometry[name][i] for name in ('panel_tilt', 'shaded_fraction') for i in range(len(pitches))})
+    n_workers = optimizer.default_worker_count() if n_workers is None else max(1, int(n_workers))
+    return _stream(env, years, pitches, system_params, key, source, statistic, dli_min, n_workers, note)
+
+
+def _stream(env, years, pitches, system_params, key, source, statistic, dli_min, n_workers, note=None):
+    start = {'event': 'start', 'years': years, 'pitches': pitches.tolist(), 'source': source, 'statistic': statistic,
+             'workers': min(n_workers, len(years))}
+    if note is not None:
+        start['note'] = note
+    yield start
+    members = []
+
+    def finished(year, run):
+        try:
+            member = run()
+        except Exception as e:
+            return {'event': 'member_error', 'year': year, 'error': f"{type(e).__name__}: {e}" if not isinstance(e, EnsembleError) else str(e)}
+        members.append(member)
+        return member
+
+    if min(n_workers, len(years)) == 1:
+        state = _member_state(env, pitches, system_params, key, source)
+        for year in years:
+            yield finished(year, lambda: _simulate_member(state, year))
+    else:
+        # Workers map one shared copy of the TMY and the geometry instead of unpickling their own
+        shared_env = env_arrays.share(env)
+        executor = optimizer.shared_pool(n_workers)
+        futures = {}
+        try:
+            for year in years:
+                futures[executor.submit(_simulate_in_worker, shared_env.shared_name, pitches, system_params, key, source, year)] = year
+            for future in as_completed(futures):
+                yield finished(futures[future], future.result)
+        finally:
+            # Reached on normal exit and when the consumer stops early (e.g. client disconnect)
+            for future in futures:
+                future.cancel()
+            env_arrays.release(shared_env)
+
+    if members:
+        yield summarize(members, pitches, statistic, dli_min)
+    else:
+        yield {'event': 'summary', 'members': 0, 'error': 'No ensemble member could be simulated.'}
+
+
+def ensemble_params(request_params):
+    """run_ensemble keyword arguments from a /simulate/ensemble payload."""
+    try:
+        system_params = dict(request_params['sys_params'])
+        for name in ('latitude', 'longitude', 'altitude', 'panel_width', 'pivot_height', 'max_tilt', 'axis_azimuth'):
+            system_params[name] = float(system_params[name])
+    except (KeyError, TypeError, ValueError) as e:
+        raise EnsembleError(f"Invalid sys_params: {e}")
+    try:
+        dli_min = (request_params.get('crop_params') or {}).get('dli_min')
+        dli_min = float(dli_min) if dli_min is not None else None
+        ground_resolution, shading_method = core.shading_options(request_params.get('ground_resolution', core.DEFAULT_GROUND_RESOLUTION),
+                                                                 request_params.get('shading_method', 'raster'))
+    except (AttributeError, TypeError, ValueError) as e:
+        raise EnsembleError(f"Invalid parameter: {e}")
+    return {
+        'system_params': system_params, 'years': request_params.get('years'), 'source': request_params.get('source'),
+        'statistic': request_params.get('statistic') or DEFAULT_STATISTIC, 'ground_resolution': ground_resolution,
+        'shading_method': shading_method, 'dli_min': dli_min
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a site over many weather years and stream one line per year, then the summary.")
+    parser.add_argument('request_file', help="JSON /simulate payload (sys_params, optional crop_params / years / source / statistic).")
+    parser.add_argument('--years', help=f"e.g. 2005-2020 or 2005,2010-2012 (default: {ENSEMBLE_YEARS}).")
+    parser.add_argument('--source', choices=SOURCES)
+    parser.add_argument('--statistic', help="Robust statistic of the water savings used to pick the pitch: mean, median or pNN.")
+    parser.add_argument('--workers', type=int, help="Simulation processes (default: all available cores).")
+    parser.add_argument('--output', help="Output file (default: stdout).")
+    args = parser.parse_args(argv)
+
+    with open(args.request_file, encoding='utf-8') as f:
+        request_params = json.load(f)
+    for name in ('years', 'source', 'statistic'):
+        if getattr(args, name) is not None:
+            request_params[name] = getattr(args, name)
+    try:
+        events = run_ensemble(n_workers=args.workers, **ensemble_params(request_params))
+    except EnsembleError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 2
+
+    failures = []
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for event in events:
+            if event['event'] == 'member_error':
+                failures.append(f"{event['year']} ({event['error']})")
+            output.write(json.dumps(event) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if failures:
+        print(f"{len(failures)} year(s) failed: {'; '.join(failures)}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
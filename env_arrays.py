@@ -0,0 +1,294 @@
+# env_arrays.py (v1.0)
+# df_env compact: kol colonne array float32 read-only (struct of arrays) 3la axe dyal l'wa9t regulier, bla DataFrame.
+# L'simulation kat-zid panel_tilt, avg_ghi_agrivoltaic... b with_columns, li kayb9a ychareki les arrays bla copie.
+# O y9der yt7et f shared memory: les workers (process pool, gunicorn) kay9raw nafs l'copie, bla pickle.
+#
+# Shared memory layout: HEADER_BYTES bytes of header (uint32 LE length + JSON metadata), then every
+# column as float32 LE, one after the other. The header is written last, so a reader that sees a
+# non-zero length sees the whole segment.
+
+import os
+import sys
+import json
+import mmap
+import time
+import atexit
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import pandas as pd
+
+DTYPE = np.dtype('<f4')
+HEADER_BYTES = 4096
+SEGMENT_FORMAT = 'agvenv/1'
+# Publish each site's weather once in shared memory for every worker process on the machine (e.g. gunicorn)
+SHARED_WEATHER = os.environ.get('AGRIVOLTAIC_SHARED_WEATHER', '').lower() in ('1', 'true', 'yes')
+SHARED_WEATHER_PREFIX = 'agvenv_'
+# Sites this process keeps published; the least recently used ones are unlinked beyond that
+SHARED_WEATHER_MAX_SITES = int(os.environ.get('AGRIVOLTAIC_SHARED_WEATHER_MAX_SITES', 32))
+# How long a reader waits for a segment that another process is still writing
+ATTACH_TIMEOUT_SECONDS = 2.0
+
+
+class EnvArrays:
+    """Read-only hourly environment: one float32 array per column on a regular time axis.
+
+    Columns are read with env['ghi'] (a read-only float32 array). with_columns derives a new
+    environment that shares the existing arrays, so a simulation never copies the weather.
+    The time index and the calendar (months, day boundaries) are built on first use and
+    shared by every environment derived from the same one.
+    """
+    # _arrays before _segment: the arrays go first when the object is freed
+    __slots__ = ('columns', 'start', 'step', '_arrays', '_segment', '_segment_columns', '_time')
+
+    def __init__(self, arrays, start, step=pd.Timedelta(hours=1), _segment=None, _segment_columns=(), _time=None):
+        self._arrays = {}
+        length = None
+        for name, values in arrays.items():
+            values = np.asarray(values, dtype=DTYPE).view()
+            values.flags.writeable = False
+            if values.ndim != 1 or (length is not None and len(values) != length):
+                raise ValueError(f"Column {name} is not a 1-D array of {length} values.")
+            length = len(values)
+            self._arrays[name] = values
+        self.columns = tuple(self._arrays)
+        self.start = pd.Timestamp(start)
+        self.step = pd.Timedelta(step)
+        self._segment = _segment
+        self._segment_columns = tuple(_segment_columns)
+        self._time = {} if _time is None else _time
+
+    @classmethod
+    def from_frame(cls, df_env):
+        """Packs a df_env DataFrame (regular DatetimeIndex) into one float32 block, one row per column."""
+        index = df_env.index
+        step = index[1] - index[0] if len(index) > 1 else pd.Timedelta(hours=1)
+        if len(index) > 2 and not (np.diff(index.asi8) == step.value).all():
+            raise ValueError("df_env must have a regular time index.")
+        block = np.empty((len(df_env.columns), len(index)), dtype=DTYPE)
+        for row, column in enumerate(df_env.columns):
+            block[row] = df_env[column].to_numpy()
+        return cls(dict(zip(df_env.columns, block)), index[0], step)
+
+    def __len__(self):
+        return len(self._arrays[self.columns[0]]) if self.columns else 0
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    @property
+    def shared_name(self):
+        """Name of the shared memory segment holding the columns, or None for a private environment."""
+        return self._segment.name if self._segment is not None else None
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self._arrays.values())
+
+    @property
+    def index(self):
+        if 'index' not in self._time:
+            self._time['index'] = pd.date_range(self.start, periods=len(self), freq=self.step)
+        return self._time['index']
+
+    def calendar(self):
+        """Hourly month / day-of-month arrays, and the first row and the date of every day."""
+        if 'calendar' not in self._time:
+            index = self.index
+            dates = index.normalize()
+            day_start = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+            self._time['calendar'] = {
+                'month': index.month.to_numpy(), 'day': index.day.to_numpy(),
+                'day_start': day_start, 'days': dates[day_start]
+            }
+        return self._time['calendar']
+
+    def daily(self, values, how='sum'):
+        """Per-day sum, mean, min or max of hourly values; (..., hours) in, (..., days) out, in float64."""
+        values = np.asarray(values, dtype=float)
+        day_start = self.calendar()['day_start']
+        if how == 'sum':
+            return np.add.reduceat(values, day_start, axis=-1)
+        if how == 'mean':
+            return np.add.reduceat(values, day_start, axis=-1) / np.diff(np.r_[day_start, values.shape[-1]])
+        if how == 'min':
+            return np.minimum.reduceat(values, day_start, axis=-1)
+        if how == 'max':
+            return np.maximum.reduceat(values, day_start, axis=-1)
+        raise ValueError(f"Unknown daily aggregation: {how}.")
+
+    def with_columns(self, **arrays):
+        """New environment with these columns added (or replaced); the other arrays are shared, not copied."""
+        return EnvArrays(dict(self._arrays, **arrays), self.start, self.step, self._segment, self._segment_columns, self._time)
+
+    def to_frame(self, columns=None):
+        """DataFrame of some columns (all by default), for exports and other paths off the hot loop."""
+        return pd.DataFrame({column: self._arrays[column] for column in (columns or self.columns)}, index=self.index)
+
+    def __reduce__(self):
+        # A shared environment travels to worker processes as its segment name only
+        if self._segment is not None and self.columns == self._segment_columns:
+            return attach, (self._segment.name,)
+        return EnvArrays, (self._arrays, self.start, self.step)
+
+    def __repr__(self):
+        shared = f", shared={self._segment.name}" if self._segment is not None else ''
+        return f"EnvArrays({len(self)} x {len(self.columns)}, start={self.start}, step={self.step}{shared})"
+
+
+def as_env(df_env):
+    """EnvArrays for a df_env DataFrame; an EnvArrays is returned as it is."""
+    return df_env if isinstance(df_env, EnvArrays) else EnvArrays.from_frame(df_env)
+
+
+# --- Shared memory ---
+class _Segment(shared_memory.SharedMemory):
+    # The arrays keep the mapping alive; closing it under them would raise BufferError at exit
+    def __del__(self):
+        pass
+
+
+class _Mapping:
+    """Read-only mapping of a segment another process created; never registered with the resource tracker."""
+
+    def __init__(self, name):
+        self.name = name
+        if os.path.isdir('/dev/shm'):
+            file_descriptor = os.open(os.path.join('/dev/shm', name), os.O_RDONLY)
+            try:
+                self.buf = mmap.mmap(file_descriptor, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(file_descriptor)
+        elif sys.version_info >= (3, 13):
+            self.buf = _Segment(name, track=False).buf
+        else:
+            # Attaching registers the segment with this process's tracker, which would unlink it at exit
+            segment = _Segment(name)
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            self.buf = segment.buf
+
+
+_owned_segments = {}
+_owned_lock = threading.Lock()
+
+
+def share(env, name=None):
+    """Copies env into a new shared memory segment and returns the EnvArrays reading from it.
+
+    The calling process owns the segment: release() (or the exit of the process) unlinks it.
+    Pickling the returned environment only sends the segment name.
+    """
+    env = as_env(env)
+    header = json.dumps({
+        'format': SEGMENT_FORMAT, 'columns': list(env.columns), 'length': len(env),
+        'start': env.start.isoformat(), 'step_seconds': env.step.total_seconds(), 'created': time.time()
+    }).encode()
+    if len(header) + 4 > HEADER_BYTES:
+        raise ValueError("Too many columns for the shared memory header.")
+    segment = _Segment(name, create=True, size=HEADER_BYTES + max(1, env.nbytes))
+    with _owned_lock:
+        # Forked children inherit this dict; only the creating process may unlink
+        _owned_segments[segment.name] = (segment, os.getpid())
+    block = np.ndarray((len(env.columns), len(env)), dtype=DTYPE, buffer=segment.buf, offset=HEADER_BYTES)
+    for row, column in enumerate(env.columns):
+        block[row] = env[column]
+    segment.buf[4:4 + len(header)] = header
+    segment.buf[:4] = struct.pack('<I', len(header))
+    return _from_segment(segment, header)
+
+
+def attach(name, timeout=ATTACH_TIMEOUT_SECONDS):
+    """EnvArrays reading a segment created by share() in any process; raises FileNotFoundError if there is none."""
+    with _owned_lock:
+        segment, _ = _owned_segments.get(name, (None, None))
+    segment = segment or _Mapping(name)
+    deadline = time.monotonic() + timeout
+    while True:
+        header_length, = struct.unpack_from('<I', segment.buf, 0)
+        if header_length:
+            return _from_segment(segment, bytes(segment.buf[4:4 + header_length]))
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Shared environment {name} was never completed.")
+        time.sleep(0.005)
+
+
+def _from_segment(segment, header):
+    header = json.loads(header)
+    if header.get('format') != SEGMENT_FORMAT:
+        raise ValueError(f"{segment.name} is not a shared environment.")
+    block = np.ndarray((len(header['columns']), header['length']), dtype=DTYPE, buffer=segment.buf, offset=HEADER_BYTES)
+    return EnvArrays(dict(zip(header['columns'], block)), header['start'], pd.Timedelta(seconds=header['step_seconds']),
+                     segment, header['columns'])
+
+
+def release(env):
+    """Unlinks the segment of a shared environment this process created; mappings already open stay valid."""
+    if env.shared_name is not None:
+        _unlink(env.shared_name)
+
+
+def _unlink(name):
+    with _owned_lock:
+        segment, owner_pid = _owned_segments.pop(name, (None, None))
+    if segment is not None and owner_pid == os.getpid():
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+@atexit.register
+def _release_all():
+    with _owned_lock:
+        names = list(_owned_segments)
+    for name in names:
+        _unlink(name)
+
+
+# --- Weather published once per machine ---
+# The version (when the cached entry was fetched) is part of the name: refreshed weather gets a new segment
+def shared_weather_name(key, version):
+    return SHARED_WEATHER_PREFIX + hashlib.sha1(repr((key, version)).encode()).hexdigest()[:20]
+
+
+# key -> name of the segment this process published for it, least recently used first
+_published = OrderedDict()
+
+
+def lookup_shared(key, version):
+    """The environment some process published for this version of a weather key, or None."""
+    name = shared_weather_name(key, version)
+    with _owned_lock:
+        if _published.get(key) == name:
+            _published.move_to_end(key)
+    try:
+        return attach(name)
+    except (FileNotFoundError, TimeoutError, ValueError):
+        return None
+
+
+def publish_shared(key, version, env):
+    """Publishes env for this version of a weather key; if another process got there first, its copy is used.
+
+    This process keeps at most SHARED_WEATHER_MAX_SITES sites published: an older version of the
+    key and the least recently used sites are unlinked (mappings already open stay valid).
+    """
+    try:
+        shared = share(env, shared_weather_name(key, version))
+    except FileExistsError:
+        return lookup_shared(key, version) or as_env(env)
+    with _owned_lock:
+        replaced = _published.pop(key, None)
+        _published[key] = shared.shared_name
+        expired = [replaced] if replaced is not None else []
+        while len(_published) > SHARED_WEATHER_MAX_SITES:
+            expired.append(_published.popitem(last=False)[1])
+    for name in expired:
+        _unlink(name)
+    return shared
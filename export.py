@@ -0,0 +1,122 @@
+# export.py (v1.0)
+# Export dyal l'series kamlin (8760 sa3a dyal df_sim, o et_open / et_agri dyal kol nhar) b CSV, NDJSON wla binary
+# b colonnes. Kolchi kaytkteb chunk b chunk f generator, ma kanbniw l'body kaml f memoire 7ta mrra.
+#
+# Binary format ("agvcol"): uint32 LE header length, JSON header, then blocks of
+#   uint32 LE row count + one float32 LE array per column (in header order).
+# The time axis is not stored: row i is at header['start'] + i * header['step_seconds'].
+
+import os
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+EXPORT_CHUNK_ROWS = int(os.environ.get('AGRIVOLTAIC_EXPORT_CHUNK_ROWS', 1000))
+
+SERIES_COLUMNS = {
+    'hourly': ('ghi', 'dhi', 'dni', 'temp_air', 'wind_speed', 'relative_humidity', 'sun_elevation', 'sun_azimuth',
+               'panel_tilt', 'avg_ghi_agrivoltaic', 'temp_agrivoltaic'),
+    'daily': ('et_open', 'et_agri')
+}
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson', 'columnar': 'application/vnd.agrivoltaic.columnar'}
+COLUMNAR_MAGIC = 'agvcol/1'
+
+
+class ExportError(ValueError):
+    pass
+
+
+def series_frame(simulation_outputs, series):
+    """The hourly df_sim or the daily ET frame of one pitch, restricted to the exportable columns."""
+    df_sim, _, _, _, et_open_series, et_agri_series = simulation_outputs
+    if series == 'hourly':
+        return df_sim.to_frame([column for column in SERIES_COLUMNS['hourly'] if column in df_sim])
+    return pd.DataFrame({'et_open': et_open_series, 'et_agri': et_agri_series})
+
+
+def select(frame, series, columns=None, start=None, end=None):
+    """Column selection and an inclusive [start, end] date range; raises ExportError on bad input.
+
+    Only a view/slice of `frame` is taken, the values are read chunk by chunk later.
+    """
+    if series not in SERIES_COLUMNS:
+        raise ExportError(f"Unknown series: {series}. Expected one of {', '.join(SERIES_COLUMNS)}.")
+    columns = list(columns) if columns else [column for column in SERIES_COLUMNS[series] if column in frame]
+    unknown = [column for column in columns if column not in frame or column not in SERIES_COLUMNS[series]]
+    if unknown:
+        raise ExportError(f"Unknown {series} column(s): {', '.join(unknown)}.")
+
+    bounds = []
+    for bound in (start, end):
+        if bound is None or bound == '':
+            bounds.append(None)
+            continue
+        try:
+            timestamp = pd.Timestamp(bound)
+        except ValueError:
+            raise ExportError(f"Invalid date: {bound}.")
+        if timestamp.tzinfo is None and frame.index.tz is not None:
+            timestamp = timestamp.tz_localize(frame.index.tz)
+        bounds.append(timestamp)
+    start, end = bounds
+    # A bare end date covers that whole day
+    if end is not None and end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1)
+    return frame.loc[start:end, columns]
+
+
+def _chunks(frame, chunk_rows):
+    for first_row in range(0, len(frame), chunk_rows):
+        yield frame.iloc[first_row:first_row + chunk_rows]
+
+
+def iter_csv(frame, chunk_rows=EXPORT_CHUNK_ROWS):
+    yield ','.join(['time'] + list(frame.columns)) + '\n'
+    for chunk in _chunks(frame, chunk_rows):
+        yield chunk.to_csv(header=False, date_format='%Y-%m-%dT%H:%M:%S%z')
+
+
+def iter_ndjson(frame, chunk_rows=EXPORT_CHUNK_ROWS):
+    for chunk in _chunks(frame, chunk_rows):
+        chunk = chunk.copy()
+        chunk.insert(0, 'time', chunk.index.strftime('%Y-%m-%dT%H:%M:%S%z'))
+        # to_json writes NaN as null, which json.dumps would not
+        yield chunk.to_json(orient='records', lines=True, double_precision=15) + '\n'
+
+
+def iter_columnar(frame, chunk_rows=EXPORT_CHUNK_ROWS):
+    step_seconds = (frame.index[1] - frame.index[0]).total_seconds() if len(frame) > 1 else None
+    header = json.dumps({
+        'format': COLUMNAR_MAGIC, 'columns': list(frame.columns), 'dtype': '<f4', 'rows': len(frame),
+        'start': frame.index[0].isoformat() if len(frame) else None, 'step_seconds': step_seconds
+    }).encode()
+    yield struct.pack('<I', len(header)) + header
+    for chunk in _chunks(frame, chunk_rows):
+        yield struct.pack('<I', len(chunk)) + b''.join(chunk[column].to_numpy(dtype='<f4').tobytes() for column in frame.columns)
+
+
+def read_columnar(payload):
+    """Decodes an agvcol payload (bytes) back into a DataFrame, for clients written in Python."""
+    header_length, = struct.unpack_from('<I', payload, 0)
+    header = json.loads(payload[4:4 + header_length])
+    offset, blocks = 4 + header_length, {column: [] for column in header['columns']}
+    while offset < len(payload):
+        rows, = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        for column in header['columns']:
+            blocks[column].append(np.frombuffer(payload, dtype=header['dtype'], count=rows, offset=offset))
+            offset += rows * 4
+    index = None
+    if header['rows']:
+        index = pd.date_range(pd.Timestamp(header['start']), periods=header['rows'], freq=pd.Timedelta(seconds=header['step_seconds'] or 3600))
+    return pd.DataFrame({column: np.concatenate(arrays) if arrays else np.array([], dtype=header['dtype'])
+                         for column, arrays in blocks.items()}, index=index)
+
+
+_WRITERS = {'csv': iter_csv, 'ndjson': iter_ndjson, 'columnar': iter_columnar}
+
+def iter_export(frame, fmt, chunk_rows=EXPORT_CHUNK_ROWS):
+    if fmt not in _WRITERS:
+        raise ExportError(f"Unknown format: {fmt}. Expected one of {', '.join(FORMATS)}.")
+    return _WRITERS[fmt](frame, chunk_rows)
@@ -0,0 +1,248 @@
+# geocoding.py (v1.0)
+# Reverse geocoding dyal /get_location_name: cache b grid cells (LRU + TTL) kayt7fed f disk, client wa7ed
+# m3awed, lookups kif kif f nafs l'we9t kaytjem3o, o rate limit 3la l'appels l'barra.
+# Backends: 'nominatim' (default), 'gazetteer' (fichier CSV local), 'stub' (bla network).
+
+import os
+import csv
+import json
+import math
+import time
+import atexit
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import weather_cache
+
+GEOCODER_BACKEND = os.environ.get('AGRIVOLTAIC_GEOCODER', '')
+GEOCODER_USER_AGENT = os.environ.get('AGRIVOLTAIC_GEOCODER_USER_AGENT', 'agrivoltaic_app_final_v1.3')
+GEOCODER_TIMEOUT = float(os.environ.get('AGRIVOLTAIC_GEOCODER_TIMEOUT', 10))
+# Nominatim's usage policy allows one request per second
+GEOCODER_MIN_INTERVAL = float(os.environ.get('AGRIVOLTAIC_GEOCODER_MIN_INTERVAL', 1.0))
+# 3 decimals is a ~110 m cell: clicks closer than that share one lookup
+GEOCODER_PRECISION = int(os.environ.get('AGRIVOLTAIC_GEOCODER_PRECISION', 3))
+CACHE_SIZE = int(os.environ.get('AGRIVOLTAIC_GEOCODER_CACHE_SIZE', 10000))
+CACHE_TTL_SECONDS = float(os.environ.get('AGRIVOLTAIC_GEOCODER_CACHE_TTL', 30 * 24 * 3600))
+CACHE_PATH = os.environ.get('AGRIVOLTAIC_GEOCODER_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'geocoding.json'))
+GAZETTEER_PATH = os.environ.get('AGRIVOLTAIC_GAZETTEER')
+GAZETTEER_MAX_DISTANCE_KM = float(os.environ.get('AGRIVOLTAIC_GAZETTEER_MAX_DISTANCE_KM', 50))
+# Persisting is batched: at most one write per interval, plus one at exit
+SAVE_INTERVAL_SECONDS = 5.0
+
+
+class GeocoderUnavailable(Exception):
+    """The backend could not answer (network error, timeout, rate limited upstream); nothing is cached."""
+
+
+# --- Backends: reverse(latitude, longitude) -> place name or None; `remote` ones are rate limited ---
+class NominatimBackend:
+    name = 'nominatim'
+    remote = True
+
+    def __init__(self, user_agent=GEOCODER_USER_AGENT, timeout=GEOCODER_TIMEOUT):
+        from geopy.geocoders import Nominatim
+        from geopy.exc import GeopyError
+        self._client = Nominatim(user_agent=user_agent, timeout=timeout)
+        self._errors = (GeopyError,)
+
+    def reverse(self, latitude, longitude):
+        try:
+            location = self._client.reverse(f"{latitude}, {longitude}", exactly_one=True)
+        except self._errors as e:
+            raise GeocoderUnavailable(str(e)) from e
+        return location.address if location else None
+
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+class GazetteerBackend:
+    """Nearest place of a local CSV gazetteer (columns: name, latitude, longitude[, country])."""
+    name = 'gazetteer'
+    remote = False
+
+    def __init__(self, path=GAZETTEER_PATH, max_distance_km=GAZETTEER_MAX_DISTANCE_KM):
+        with open(path, newline='', encoding='utf-8') as f:
+            self.places = [(row['name'], float(row['latitude']), float(row['longitude']), row.get('country') or '')
+                           for row in csv.DictReader(f)]
+        self.max_distance_km = max_distance_km
+
+    def reverse(self, latitude, longitude):
+        best_name, best_distance = None, self.max_distance_km
+        for name, place_latitude, place_longitude, country in self.places:
+            distance = _distance_km(latitude, longitude, place_latitude, place_longitude)
+            if distance <= best_distance:
+                best_name, best_distance = (f"{name}, {country}" if country else name), distance
+        return best_name
+
+
+class StubBackend:
+    """Offline stand-in that names a point by its coordinates; for tests and air-gapped runs."""
+    name = 'stub'
+    remote = False
+
+    def reverse(self, latitude, longitude):
+        return f"{abs(latitude):.3f}°{'N' if latitude >= 0 else 'S'}, {abs(longitude):.3f}°{'E' if longitude >= 0 else 'W'}"
+
+
+BACKENDS = {'nominatim': NominatimBackend, 'gazetteer': GazetteerBackend, 'stub': StubBackend}
+
+
+def make_backend(name=None):
+    """Builds the configured backend; offline mode falls back to the gazetteer (if one is configured) or the stub."""
+    if not name:
+        if weather_cache.OFFLINE:
+            name = 'gazetteer' if GAZETTEER_PATH else 'stub'
+        else:
+            name = 'nominatim'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown geocoder backend: {name}. Expected one of {', '.join(BACKENDS)}.")
+    return BACKENDS[name]()
+
+
+class _RateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next_call - now)
+            self._next_call = max(now, self._next_call) + self.min_interval
+        if delay:
+            time.sleep(delay)
+
+
+class ReverseGeocoder:
+    """Cached, coalescing, rate-limited reverse geocoder over one backend.
+
+    Points are snapped to a grid of `precision` decimal degrees; one lookup (made at the
+    cell's own coordinates) answers every point of the cell for `ttl_seconds`.
+    """
+
+    def __init__(self, backend, precision=GEOCODER_PRECISION, max_entries=CACHE_SIZE, ttl_seconds=CACHE_TTL_SECONDS,
+                 cache_path=CACHE_PATH, min_interval=GEOCODER_MIN_INTERVAL):
+        self.backend = backend
+        self.precision = precision
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.cache_path = cache_path
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # Only calls leaving the machine are rate limited
+        self._rate_limiter = _RateLimiter(min_interval if getattr(backend, 'remote', True) else 0.0)
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+
+    def cell(self, latitude, longitude):
+        return round(float(latitude), self.precision), round(float(longitude), self.precision)
+
+    def _cache_key(self, cell):
+        # The backend is part of the key, so switching backends never serves the other one's names
+        return f"{self.backend.name}:{self.precision}:{cell[0]:.{self.precision}f},{cell[1]:.{self.precision}f}"
+
+    def reverse(self, latitude, longitude):
+        """Place name of the point's cell, or None when the backend knows none; raises GeocoderUnavailable."""
+        cell = self.cell(latitude, longitude)
+        key = self._cache_key(cell)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            self._rate_limiter.wait()
+            name = self.backend.reverse(*cell)
+        except Exception as e:
+            # Failures are not cached; the callers waiting on this lookup get the same exception
+            with self._lock:
+                self.stats['errors'] += 1
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._entries[key] = (name, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+            del self._in_flight[key]
+        future.set_result(name)
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL_SECONDS:
+            self.save()
+        return name
+
+    def _load(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        # Stored oldest first, so reinserting keeps the LRU order
+        for key, name, stored_at in stored.get('entries', []):
+            if now - stored_at <= self.ttl_seconds:
+                self._entries[key] = (name, stored_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Writes the cache atomically; a failure only costs the persistence."""
+        if not self.cache_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[key, name, stored_at] for key, (name, stored_at) in self._entries.items()]
+            self._dirty = False
+            self._last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.cache_path), suffix='.tmp')
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as f:
+                json.dump({'entries': entries}, f, ensure_ascii=False)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print(f"WARNING: could not write the geocoding cache: {e}")
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), in_flight=len(self._in_flight),
+                        backend=self.backend.name, precision=self.precision)
+
+
+_default_geocoder = None
+_default_lock = threading.Lock()
+
+def default_geocoder():
+    """Process-wide geocoder, built on first use so importing the app never touches the network."""
+    global _default_geocoder
+    with _default_lock:
+        if _default_geocoder is None:
+            _default_geocoder = ReverseGeocoder(make_backend(GEOCODER_BACKEND))
+            atexit.register(_default_geocoder.save)
+        return _default_geocoder
@@ -0,0 +1,189 @@
+# graph_payload.py (v1.0)
+# Mode "compact" dyal graph_data: les series kaymchiw float32 f base64, o labels dyal dates/sa3at kaymchiw
+# start + step bla ma n3awdo 365 string. L'body kaytcompressa b brotli wla gzip ila l'client bgha.
+#
+# Encoded dataset:  'data': {'dtype': 'float32', 'shape': [n] or [n, 2] for {x, y} points, 'base64': ...}
+# Encoded labels:   {'kind': 'dates', 'start': 'YYYY-MM-DD', 'step_days', 'count'}
+#                   {'kind': 'times', 'start_minutes', 'step_minutes', 'count'}   ('HH:MM' strings)
+#                   {'kind': 'range', 'start', 'step', 'count'}                   (evenly spaced numbers)
+#                   {'kind': 'float32', 'base64', 'count'}                        (other numbers)
+# Label lists that fit none of these (e.g. month names) are sent as they are.
+
+import gzip
+import json
+import time
+import base64
+from datetime import date, timedelta
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GRAPH_ENCODING = 'compact/1'
+# Below this, compressing costs more than it saves
+MIN_COMPRESS_BYTES = 1024
+
+
+def _encode_floats(values):
+    array = np.asarray(values, dtype='<f4')
+    return {'dtype': 'float32', 'shape': list(array.shape), 'base64': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def _decode_floats(encoded):
+    return np.frombuffer(base64.b64decode(encoded['base64']), dtype='<f4').reshape(encoded['shape'])
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.floating, np.integer)) and not isinstance(value, bool)
+
+
+def _regular_step(values):
+    """Common step of an evenly spaced sequence, or None; the caller checks the rebuilt labels match exactly."""
+    if len(values) < 2:
+        return None
+    return values[1] - values[0]
+
+
+def _compact_labels(labels):
+    if not labels or not isinstance(labels, list):
+        return labels
+    if all(_is_number(label) for label in labels):
+        start, step = float(labels[0]), _regular_step([float(label) for label in labels])
+        if step is not None and [start + i * step for i in range(len(labels))] == [float(label) for label in labels]:
+            return {'kind': 'range', 'start': start, 'step': step, 'count': len(labels)}
+        return {'kind': 'float32', 'base64': _encode_floats(labels)['base64'], 'count': len(labels)}
+    if not all(isinstance(label, str) for label in labels):
+        return labels
+
+    try:
+        days = [date.fromisoformat(label) for label in labels]
+    except ValueError:
+        days = None
+    if days is not None:
+        step = _regular_step(days)
+        if step is not None and _expand_labels({'kind': 'dates', 'start': labels[0], 'step_days': step.days, 'count': len(labels)}) == labels:
+            return {'kind': 'dates', 'start': labels[0], 'step_days': step.days, 'count': len(labels)}
+        return labels
+
+    try:
+        minutes = [int(label[:2]) * 60 + int(label[3:]) for label in labels]
+    except ValueError:
+        return labels
+    step = _regular_step(minutes)
+    compact = {'kind': 'times', 'start_minutes': minutes[0], 'step_minutes': step, 'count': len(labels)}
+    return compact if step is not None and _expand_labels(compact) == labels else labels
+
+
+def _expand_labels(labels):
+    if not isinstance(labels, dict):
+        return labels
+    count = labels['count']
+    if labels['kind'] == 'range':
+        return [labels['start'] + i * labels['step'] for i in range(count)]
+    if labels['kind'] == 'float32':
+        return np.frombuffer(base64.b64decode(labels['base64']), dtype='<f4').tolist()
+    if labels['kind'] == 'dates':
+        start = date.fromisoformat(labels['start'])
+        return [(start + timedelta(days=i * labels['step_days'])).isoformat() for i in range(count)]
+    minutes = [labels['start_minutes'] + i * labels['step_minutes'] for i in range(count)]
+    return [f"{minute // 60 % 24:02d}:{minute % 60:02d}" for minute in minutes]
+
+
+def _compact_data(data):
+    if isinstance(data, list) and data and all(isinstance(point, dict) and 'x' in point and 'y' in point for point in data):
+        return _encode_floats([[point['x'], point['y']] for point in data])
+    if isinstance(data, list) and all(_is_number(value) for value in data):
+        return _encode_floats(data)
+    return data
+
+
+def compact_graph_data(graph_data):
+    """Same structure as graph_data, with numeric series as base64 float32 and regular labels as start + step."""
+    compact = {}
+    for graph_key, graph in graph_data.items():
+        if not isinstance(graph, dict):
+            compact[graph_key] = graph
+            continue
+        graph = dict(graph)
+        if 'labels' in graph:
+            graph['labels'] = _compact_labels(graph['labels'])
+        if 'datasets' in graph:
+            graph['datasets'] = [dict(dataset, data=_compact_data(dataset.get('data'))) for dataset in graph['datasets']]
+        compact[graph_key] = graph
+    return compact
+
+
+def expand_graph_data(graph_data):
+    """Inverse of compact_graph_data (up to float32 rounding); script.js does the same in decodeGraphData."""
+    expanded = {}
+    for graph_key, graph in graph_data.items():
+        if not isinstance(graph, dict):
+            expanded[graph_key] = graph
+            continue
+        graph = dict(graph)
+        if 'labels' in graph:
+            graph['labels'] = _expand_labels(graph['labels'])
+        datasets = []
+        for dataset in graph.get('datasets', []):
+            data = dataset.get('data')
+            if isinstance(data, dict) and data.get('dtype') == 'float32':
+                values = _decode_floats(data)
+                data = [{'x': float(x), 'y': float(y)} for x, y in values] if values.ndim == 2 else values.tolist()
+            datasets.append(dict(dataset, data=data))
+        if 'datasets' in graph:
+            graph['datasets'] = datasets
+        expanded[graph_key] = graph
+    return expanded
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks 'br', 'gzip' or None from a werkzeug Accept-Encoding header object."""
+    if brotli is not None and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(payload, content_encoding):
+    if content_encoding is None or len(payload) < MIN_COMPRESS_BYTES:
+        return payload, None
+    if content_encoding == 'br':
+        return brotli.compress(payload, quality=5), 'br'
+    return gzip.compress(payload, compresslevel=6), 'gzip'
+
+
+def encode_body(body, compact=False, content_encoding=None):
+    """Serializes a /simulate body; returns (bytes, content_encoding actually used, stats).
+
+    stats has the uncompressed and sent sizes and the encode / compress times, in both modes.
+    """
+    start_time = time.perf_counter()
+    if compact and body.get('graph_data') is not None:
+        body = dict(body, graph_data=compact_graph_data(body['graph_data']), graph_encoding=GRAPH_ENCODING)
+    payload = json.dumps(body, separators=(',', ':'), default=float).encode()
+    encode_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    sent, content_encoding = compress(payload, content_encoding)
+    return sent, content_encoding, {
+        'mode': 'compact' if compact else 'json', 'json_bytes': len(payload), 'sent_bytes': len(sent),
+        'encode_ms': encode_seconds * 1000, 'compress_ms': (time.perf_counter() - start_time) * 1000,
+        'content_encoding': content_encoding
+    }
+
+
+def measure_payload(body, repeat=5):
+    """Sizes and encode times of a body in both modes and with each available compression, for comparison."""
+    report = []
+    for compact in (False, True):
+        for content_encoding in (None, 'gzip') + (('br',) if brotli is not None else ()):
+            timings = []
+            for _ in range(repeat):
+                _, _, stats = encode_body(body, compact, content_encoding)
+                timings.append(stats['encode_ms'] + stats['compress_ms'])
+            stats.update(requested_encoding=content_encoding, total_ms=min(timings))
+            report.append(stats)
+    return report
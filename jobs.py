@@ -0,0 +1,207 @@
+# jobs.py (v1.0)
+# Job API dyal /simulate: l'request kayrj3 job id direct, o simulation kadour f pool m7doud dyal threads.
+# L'client kaydir poll wla SSE bach ychouf l'progress, mn b3d kayjib resultat.
+
+import os
+import time
+import json
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = int(os.environ.get('AGRIVOLTAIC_JOB_WORKERS', 2))
+MAX_PENDING_JOBS = int(os.environ.get('AGRIVOLTAIC_MAX_PENDING_JOBS', 16))
+JOB_RETENTION_SECONDS = float(os.environ.get('AGRIVOLTAIC_JOB_RETENTION', 600))
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+def canonical_key(params):
+    """Stable hash of a request payload, used to spot identical in-flight jobs."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class Job:
+    def __init__(self, key, params):
+        self.job_id = uuid.uuid4().hex
+        self.key = key
+        self.params = params
+        self.status = 'queued'
+        self.stage = None
+        self.events = []
+        self.result = None
+        self.status_code = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = False
+        self.future = None
+        # One handle per submitter still waiting for the result; the first one is the job id
+        self.handles = {self.job_id}
+        self._condition = threading.Condition()
+
+    def _append_event(self, event):
+        event['seq'] = len(self.events) + 1
+        event['time'] = time.time()
+        self.events.append(event)
+        self._condition.notify_all()
+
+    def publish(self, stage, **detail):
+        """Progress callback handed to the simulation; raising here is how a running job is cancelled."""
+        with self._condition:
+            if self.cancel_requested:
+                raise JobCancelled()
+            self.stage = stage
+            self._append_event(dict(detail, type='progress', stage=stage))
+
+    def finish(self, status, result=None, status_code=None, error=None):
+        with self._condition:
+            self.status = status
+            self.result = result
+            self.status_code = status_code
+            self.error = error
+            self.finished_at = time.time()
+            self._append_event({'type': 'done', 'status': status, 'error': error})
+
+    def mark_running(self):
+        with self._condition:
+            self.status = 'running'
+            self._append_event({'type': 'status', 'status': 'running'})
+
+    def events_after(self, seq, timeout):
+        """Events newer than `seq`, waiting up to `timeout` seconds for one to arrive."""
+        with self._condition:
+            if len(self.events) <= seq and self.status in ACTIVE_STATUSES:
+                self._condition.wait(timeout)
+            return self.events[seq:]
+
+    def snapshot(self):
+        with self._condition:
+            last_progress = next((event for event in reversed(self.events) if event['type'] == 'progress'), None)
+            return {
+                'job_id': self.job_id,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': last_progress,
+                'error': self.error,
+                'cancel_requested': self.cancel_requested,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at
+            }
+
+
+class JobManager:
+    """Runs `run_function(params, progress)` jobs on a bounded thread pool.
+
+    run_function returns a (body, status_code) pair, like a Flask view without jsonify.
+    Identical payloads submitted while one is still queued or running share that job; each
+    submitter gets its own handle, and the job is only cancelled once every handle withdrew.
+    """
+
+    def __init__(self, run_function, max_workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS, retention_seconds=JOB_RETENTION_SECONDS):
+        self.run_function = run_function
+        self.max_pending = max_pending
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simulation-job')
+        self._jobs = {}
+        self._active_by_key = {}
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def submit(self, params):
+        """Returns (job, handle, deduplicated); raises QueueFull when too many jobs are pending.
+
+        The handle works wherever a job id does (status, events, result, cancel).
+        """
+        key = canonical_key(params)
+        with self._lock:
+            self._purge_finished()
+            existing = self._active_by_key.get(key)
+            if existing is not None:
+                with existing._condition:
+                    if existing.status in ACTIVE_STATUSES and not existing.cancel_requested:
+                        handle = uuid.uuid4().hex
+                        existing.handles.add(handle)
+                        self._handles[handle] = existing
+                        return existing, handle, True
+            active_count = sum(1 for job in self._jobs.values() if job.status in ACTIVE_STATUSES)
+            if active_count >= self.max_pending:
+                raise QueueFull(f"Too many pending simulations ({active_count}), please retry later.")
+            job = Job(key, params)
+            self._jobs[job.job_id] = job
+            self._active_by_key[key] = job
+        job.future = self._executor.submit(self._run, job, params)
+        return job, job.job_id, False
+
+    def get(self, handle):
+        with self._lock:
+            # Lookups purge too, so finished jobs expire even when nothing new is submitted
+            self._purge_finished()
+            return self._jobs.get(handle) or self._handles.get(handle)
+
+    def cancel(self, handle):
+        """Withdraws one submitter; once none is left, a queued job is cancelled at once and a
+        running one stops at its next progress report."""
+        job = self.get(handle)
+        if job is None:
+            return None
+        with job._condition:
+            if job.status not in ACTIVE_STATUSES:
+                return job
+            job.handles.discard(handle)
+            if job.handles:
+                return job
+            job.cancel_requested = True
+        if job.future is not None and job.future.cancel():
+            job.finish('cancelled')
+            self._release(job)
+        return job
+
+    def stats(self):
+        with self._lock:
+            self._purge_finished()
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'succeeded', 'failed', 'cancelled')}
+
+    def _run(self, job, params):
+        try:
+            if job.cancel_requested:
+                raise JobCancelled()
+            job.mark_running()
+            body, status_code = self.run_function(params, job.publish)
+            if status_code >= 400:
+                job.finish('failed', body, status_code, body.get('error'))
+            else:
+                job.finish('succeeded', body, status_code)
+        except JobCancelled:
+            job.finish('cancelled')
+        except Exception as e:
+            import traceback
+            print(f"An error occurred in simulation job {job.job_id}: {e}")
+            traceback.print_exc()
+            job.finish('failed', {'error': str(e)}, 500, str(e))
+        finally:
+            self._release(job)
+
+    def _release(self, job):
+        with self._lock:
+            if self._active_by_key.get(job.key) is job:
+                del self._active_by_key[job.key]
+
+    def _purge_finished(self):
+        now = time.time()
+        expired = {job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.retention_seconds}
+        for job_id in expired:
+            del self._jobs[job_id]
+        for handle in [handle for handle, job in self._handles.items() if job.job_id in expired]:
+            del self._handles[handle]
@@ -0,0 +1,277 @@
+# metrics.py (v1.0)
+# Instrumentation khfifa: wa9t kol stage (l'Server-Timing o histograms), counters dyal errors o caches,
+# o /metrics b format texte dyal Prometheus. Profiler b sampling (opt-in) l'requests li kattwel bzzaf.
+
+import os
+import sys
+import time
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Profiling is off unless a threshold is set
+PROFILE_THRESHOLD_SECONDS = float(os.environ.get('AGRIVOLTAIC_PROFILE_THRESHOLD_MS', 0)) / 1000
+PROFILE_DIR = os.environ.get('AGRIVOLTAIC_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'profiles'))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get('AGRIVOLTAIC_PROFILE_INTERVAL_MS', 5)) / 1000
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+
+class GaugeMetric(CounterMetric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramMetric(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, (counts, total) in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(CounterMetric(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(GaugeMetric(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(HistogramMetric(name, documentation, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """`collect()` refreshes gauges from some other component's own counters just before rendering."""
+        self.collectors.append(collect)
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"WARNING: metrics collector failed: {e}")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('agrivoltaic_stage_seconds', 'Time spent in each simulation stage.', ('stage', 'mode'))
+REQUEST_SECONDS = registry.histogram('agrivoltaic_request_seconds', 'HTTP request latency (time to the response headers).', ('endpoint', 'method', 'status', 'mode'))
+REQUESTS_IN_FLIGHT = registry.gauge('agrivoltaic_requests_in_flight', 'HTTP requests being handled.')
+SIMULATIONS_IN_FLIGHT = registry.gauge('agrivoltaic_simulations_in_flight', 'Simulations running (blocking requests and jobs).', ('mode',))
+PVGIS_REQUESTS = registry.counter('agrivoltaic_pvgis_requests_total', 'Weather lookups by outcome (cache_hit, fetched, stale_fallback, offline_miss, error).', ('outcome',))
+PVGIS_ERRORS = registry.counter('agrivoltaic_pvgis_errors_total', 'Failed PVGIS downloads.')
+PIPELINE_STAGES = registry.counter('agrivoltaic_pipeline_stages_total', 'Pipeline stage evaluations by status (recomputed, reused, provided).', ('stage', 'status'))
+CACHE_HITS = registry.gauge('agrivoltaic_cache_hits', 'Hits of each in-process cache since start.', ('cache',))
+CACHE_MISSES = registry.gauge('agrivoltaic_cache_misses', 'Misses of each in-process cache since start.', ('cache',))
+CACHE_HIT_RATIO = registry.gauge('agrivoltaic_cache_hit_ratio', 'hits / (hits + misses) of each in-process cache.', ('cache',))
+GEOCODER_ERRORS = registry.gauge('agrivoltaic_geocoder_errors', 'Failed reverse-geocoding backend calls since start.', ('backend',))
+JOBS = registry.gauge('agrivoltaic_jobs', 'Simulation jobs known to the job manager, by status.', ('status',))
+PROFILES_WRITTEN = registry.counter('agrivoltaic_profiles_written_total', 'Profiles dumped for slow requests.')
+
+
+def set_cache_stats(cache, hits, misses):
+    CACHE_HITS.set(hits, cache=cache)
+    CACHE_MISSES.set(misses, cache=cache)
+    CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+
+
+# --- Per-request stage timings ---
+_timings = contextvars.ContextVar('agrivoltaic_timings', default=None)
+_mode = contextvars.ContextVar('agrivoltaic_mode', default='none')
+# Name of the timed() block being run; blocks nested in it are recorded as 'parent.child'
+_scope = contextvars.ContextVar('agrivoltaic_scope', default=None)
+
+
+@contextmanager
+def collect_timings(mode='none'):
+    """Collects the stage timings of the code run inside it (same thread) into the yielded dict.
+
+    Nested stages are keyed 'parent.child' and are a breakdown of their parent: only the
+    top-level (dot-free) entries add up to the time spent.
+    """
+    timings = {}
+    timings_token, mode_token = _timings.set(timings), _mode.set(mode)
+    try:
+        yield timings
+    finally:
+        _timings.reset(timings_token)
+        _mode.reset(mode_token)
+
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage, mode=_mode.get())
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    parent = _scope.get()
+    stage = f"{parent}.{stage}" if parent else stage
+    scope_token = _scope.set(stage)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _scope.reset(scope_token)
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def server_timing_header(timings):
+    """Server-Timing value, e.g. 'weather;dur=12.3, optimization.shading;dur=4.0'; names are made token-safe."""
+    entries = []
+    for stage, seconds in timings.items():
+        name = ''.join(character if character.isalnum() or character in '-_.' else '_' for character in stage)
+        entries.append(f"{name};dur={seconds * 1000:.1f}")
+    return ', '.join(entries)
+
+
+# --- Opt-in sampling profiler ---
+class SamplingProfiler:
+    """Samples one thread's Python stack every `interval` seconds, in a helper thread.
+
+    The result is in collapsed-stack format ("outer;inner;leaf count" per line), which
+    flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_SECONDS):
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+@contextmanager
+def profile_if_slow(label, threshold=None):
+    """Profiles the block when profiling is enabled, and keeps the profile only if it took longer than threshold."""
+    threshold = PROFILE_THRESHOLD_SECONDS if threshold is None else threshold
+    if threshold <= 0:
+        yield
+        return
+    profiler = SamplingProfiler().start()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= threshold and profiler.stacks:
+            _write_profile(label, elapsed, profiler)
+
+
+def _write_profile(label, elapsed, profiler):
+    safe_label = ''.join(character if character.isalnum() or character in '-_.' else '_' for character in label)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}_{safe_label}_{elapsed * 1000:.0f}ms.folded")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+        PROFILES_WRITTEN.inc()
+        print(f"Slow request profiled ({elapsed:.2f} s): {path}")
+    except OSError as e:
+        print(f"WARNING: could not write the profile: {e}")
@@ -0,0 +1,392 @@
+# optimizer.py (v1.0)
+# Layout optimizer: bounded search 3la l'pitch, o joint search 3la pitch / pivot height / max tilt.
+# L'evaluations dyal l'joint search kaydouro f process pool 3la ga3 les cores.
+
+import os
+import time
+import operator
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import simulation_core as core
+import env_arrays
+
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+DEFAULT_PITCH_BOUNDS = (4.0, 10.0)
+DEFAULT_LAYOUT_BOUNDS = {'pitch': DEFAULT_PITCH_BOUNDS, 'pivot_height': (2.0, 5.0), 'max_tilt': (30.0, 60.0)}
+# Outer limits for layout_bounds given in a request
+LAYOUT_LIMITS = {'pitch': (1.0, 50.0), 'pivot_height': (0.5, 20.0), 'max_tilt': (0.0, 90.0)}
+# A millimetre is far below what a row layout can be built to
+MIN_PITCH_TOLERANCE = 0.001
+# 0.618^60 of the bracket is below float spacing: the cap only stops searches that could never converge
+MAX_GOLDEN_ITERATIONS = 60
+
+_CONSTRAINT_OPERATORS = {'>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt}
+# Workers come from a fork server (spawn where there is none), never from forking the threaded web
+# server: a fork copies the locks other threads hold at that moment and can deadlock the child
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Size of the process pool shared by batch and ensemble requests; 0 means all available cores
+POOL_WORKERS = int(os.environ.get('AGRIVOLTAIC_POOL_WORKERS', 0))
+
+
+def default_worker_count():
+    """Number of cores this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def pool_context():
+    return multiprocessing.get_context(POOL_START_METHOD)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def shared_pool(max_workers=None):
+    """Process pool shared by every batch and ensemble of this process, created on first use.
+
+    Concurrent requests queue their tasks on it rather than each starting processes of their own.
+    The first call sets its size: POOL_WORKERS, else max_workers, else all available cores.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        # A worker killed by the system (e.g. out of memory) breaks a pool for good
+        if _shared_pool is None or _shared_pool._broken:
+            _shared_pool = ProcessPoolExecutor(max_workers=POOL_WORKERS or max_workers or default_worker_count(), mp_context=pool_context())
+        return _shared_pool
+
+
+def pitch_tolerance(value):
+    """pitch_tolerance of a request: None (empty or 0, the discrete sweep) or a float >= MIN_PITCH_TOLERANCE; raises ValueError."""
+    if value is None or value == '' or value == 0:
+        return None
+    try:
+        tolerance = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid pitch tolerance: {value!r}.")
+    if not MIN_PITCH_TOLERANCE <= tolerance < float('inf'):
+        raise ValueError(f"The pitch tolerance must be at least {MIN_PITCH_TOLERANCE} m.")
+    return tolerance
+
+
+def layout_bounds(value=None):
+    """Search bounds of a request's layout_search: DEFAULT_LAYOUT_BOUNDS, overridden by {name: [low, high]}; raises ValueError."""
+    bounds = dict(DEFAULT_LAYOUT_BOUNDS)
+    if value is None:
+        return bounds
+    if not isinstance(value, dict):
+        raise ValueError("layout_bounds must map parameters to [low, high].")
+    for name, pair in value.items():
+        if name not in LAYOUT_LIMITS:
+            raise ValueError(f"Unknown layout parameter: {name}. Expected one of {', '.join(LAYOUT_LIMITS)}.")
+        try:
+            low, high = (float(bound) for bound in pair)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid bounds for {name}: {pair!r}.")
+        limit_low, limit_high = LAYOUT_LIMITS[name]
+        if not limit_low <= low < high <= limit_high:
+            raise ValueError(f"Bounds for {name} must satisfy {limit_low} <= low < high <= {limit_high}.")
+        bounds[name] = (low, high)
+    return bounds
+
+
+def _constraint_satisfied(constraint, results):
+    if callable(constraint):
+        return bool(constraint(results))
+    metric, op, value = constraint
+    return _CONSTRAINT_OPERATORS[op](results[metric], value)
+
+
+def _constraint_violation(constraint, results):
+    # How far an unmet constraint is from being met, so the searches can head for the feasible region
+    if _constraint_satisfied(constraint, results):
+        return 0.0
+    if callable(constraint):
+        return 1.0
+    metric, _, value = constraint
+    return abs(float(results[metric]) - float(value))
+
+
+def _objective_value(objective, results):
+    return float(objective(results)) if callable(objective) else float(results[objective])
+
+
+def _evaluate_layout(df_env, system_params, layout, ground_resolution, shading_method):
+    params = dict(system_params)
+    params.update({key: value for key, value in layout.items() if key != 'pitch'})
+    simulation_outputs = core._run_shading_and_et_simulation(df_env, params, layout['pitch'], ground_resolution, shading_method)
+    return simulation_outputs
+
+
+# --- Process pool workers ---
+# [MODIFIED v1.8] df_env kaymchi f shared memory: kol task kaywsslo ghir smiya dyal l'segment.
+def _evaluate_in_worker(shared_name, system_params, layout, ground_resolution, shading_method):
+    # Attached in the task (no initializer), so the searches share optimizer.shared_pool with the other requests
+    simulation_outputs = _evaluate_layout(env_arrays.attach(shared_name), system_params, layout, ground_resolution, shading_method)
+    return core._pitch_results(simulation_outputs)
+
+
+class _Search:
+    """Bookkeeping shared by both searches: scoring, deduplication, history and the best feasible point."""
+
+    def __init__(self, objective, maximize, constraints):
+        self.objective = objective
+        self.maximize = maximize
+        self.constraints = list(constraints)
+        self.history = []
+        self.seen = {}
+        self.best = None
+        self.start_time = time.perf_counter()
+
+    def loss(self, results):
+        # Infeasible layouts are never preferred over feasible ones
+        if not all(_constraint_satisfied(c, results) for c in self.constraints):
+            return np.inf
+        value = _objective_value(self.objective, results)
+        return -value if self.maximize else value
+
+    def rank(self, results):
+        # Feasible layouts by loss, then infeasible ones by total violation
+        loss = self.loss(results)
+        if np.isfinite(loss):
+            return (0, loss)
+        return (1, sum(_constraint_violation(c, results) for c in self.constraints))
+
+    @staticmethod
+    def key(layout):
+        return tuple(sorted((name, round(float(value), 6)) for name, value in layout.items()))
+
+    def record(self, layout, results):
+        rank = self.rank(results)
+        entry = {'layout': layout, 'results': results, 'feasible': rank[0] == 0,
+                 'objective': _objective_value(self.objective, results)}
+        self.history.append(entry)
+        self.seen[self.key(layout)] = rank
+        if self.best is None or rank < self.best['rank']:
+            self.best = dict(entry, rank=rank)
+        return rank
+
+    def report(self):
+        best = self.best or {}
+        return {
+            'best_layout': best.get('layout'),
+            'best_results': best.get('results'),
+            'best_objective': best.get('objective'),
+            'feasible': bool(best.get('feasible', False)),
+            'evaluations': len(self.history),
+            'wall_time_s': time.perf_counter() - self.start_time,
+            'history': self.history
+        }
+
+
+def optimize_pitch(df_env, system_params, bounds=DEFAULT_PITCH_BOUNDS, tol=0.05, objective='water_savings', maximize=True,
+                   constraints=(), ground_resolution=core.DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    """Golden-section search on pitch alone, down to a bracket narrower than `tol` metres.
+
+    One pitch costs a few tens of milliseconds, so the search runs in-process; a pool would
+    cost more to start than it saves on this strictly sequential method.
+    `objective` is a key of the per-pitch results (or a callable on them), and `constraints`
+    are callables or (metric, op, value) tuples, e.g. ('dli_agri', '>=', crop_params['dli_min']).
+    """
+    df_env = env_arrays.as_env(df_env)
+    search = _Search(objective, maximize, constraints)
+    outputs_by_pitch = {}
+
+    def evaluate(pitch):
+        pitch = float(pitch)
+        key = search.key({'pitch': pitch})
+        if key not in search.seen:
+            simulation_outputs = _evaluate_layout(df_env, system_params, {'pitch': pitch}, ground_resolution, shading_method)
+            search.record({'pitch': pitch}, core._pitch_results(simulation_outputs))
+            core._report_progress(progress, 'optimization', pitch=pitch, done=len(search.history))
+            # Only the best pitch's hourly outputs are kept, for the graphs
+            if search.best['layout']['pitch'] == pitch:
+                outputs_by_pitch.clear()
+                outputs_by_pitch[pitch] = simulation_outputs
+        return search.seen[key]
+
+    low, high = bounds
+    inner_low = high - GOLDEN_RATIO * (high - low)
+    inner_high = low + GOLDEN_RATIO * (high - low)
+    rank_low, rank_high = evaluate(inner_low), evaluate(inner_high)
+    iterations = 0
+    while high - low > tol and iterations < MAX_GOLDEN_ITERATIONS:
+        iterations += 1
+        if rank_low <= rank_high:
+            high, inner_high, rank_high = inner_high, inner_low, rank_low
+            inner_low = high - GOLDEN_RATIO * (high - low)
+            rank_low = evaluate(inner_low)
+        else:
+            low, inner_low, rank_low = inner_low, inner_high, rank_high
+            inner_high = low + GOLDEN_RATIO * (high - low)
+            rank_high = evaluate(inner_high)
+    # The optimum of a monotonic objective sits on a bound, which golden-section never probes
+    evaluate(bounds[0])
+    evaluate(bounds[1])
+
+    report = search.report()
+    report['simulation_outputs'] = outputs_by_pitch.get(report['best_layout']['pitch'])
+    return report
+
+
+def optimize_layout(df_env, system_params, bounds=None, objective='water_savings', maximize=True, constraints=(),
+                    tol=0.01, max_evaluations=200, n_workers=None,
+                    ground_resolution=core.DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    """Joint search over several layout parameters (pitch, pivot_height, max_tilt by default).
+
+    Parallel pattern search: every poll evaluates the +/- step neighbours of the current best
+    layout along each parameter as one batch on the shared process pool, moves to the best improving
+    neighbour, or halves the step when none improves. It stops once the step is below `tol`
+    (a fraction of each parameter's range) or after `max_evaluations` simulations.
+    """
+    bounds = dict(bounds or DEFAULT_LAYOUT_BOUNDS)
+    names = list(bounds)
+    lower = np.array([bounds[name][0] for name in names], dtype=float)
+    span = np.array([bounds[name][1] - bounds[name][0] for name in names], dtype=float)
+    n_workers = n_workers or default_worker_count()
+
+    def to_layout(point):
+        return {name: float(value) for name, value in zip(names, lower + point * span)}
+
+    start_values = [system_params.get(name, bounds[name][0] + 0.5 * (bounds[name][1] - bounds[name][0])) for name in names]
+    center = np.clip((np.array(start_values, dtype=float) - lower) / np.where(span > 0, span, 1), 0, 1)
+    step = 0.25
+
+    df_env = env_arrays.as_env(df_env)
+    search = _Search(objective, maximize, constraints)
+    executor, shared_env = None, None
+    if n_workers > 1:
+        # The workers map this process's copy instead of unpickling their own
+        shared_env = df_env if df_env.shared_name is not None else env_arrays.share(df_env)
+        executor = shared_pool(n_workers)
+
+    def evaluate_batch(points):
+        layouts = []
+        for point in points:
+            layout = to_layout(point)
+            if search.key(layout) not in search.seen and search.key(layout) not in {search.key(l) for l in layouts}:
+                layouts.append(layout)
+        layouts = layouts[:max(0, max_evaluations - len(search.history))]
+        if executor is not None:
+            futures = [executor.submit(_evaluate_in_worker, shared_env.shared_name, system_params, layout, ground_resolution, shading_method)
+                       for layout in layouts]
+            try:
+                batch_results = [future.result() for future in futures]
+            finally:
+                for future in futures:
+                    future.cancel()
+        else:
+            batch_results = [core._pitch_results(_evaluate_layout(df_env, system_params, layout, ground_resolution, shading_method))
+                             for layout in layouts]
+        for layout, results in zip(layouts, batch_results):
+            search.record(layout, results)
+        core._report_progress(progress, 'optimization', done=len(search.history))
+
+    try:
+        evaluate_batch([center])
+        center_rank = search.seen[search.key(to_layout(center))]
+        while step >= tol and len(search.history) < max_evaluations:
+            poll = []
+            for axis in range(len(names)):
+                for direction in (-1, 1):
+                    point = center.copy()
+                    point[axis] = np.clip(point[axis] + direction * step, 0, 1)
+                    poll.append(point)
+            evaluate_batch(poll)
+            best_point, best_rank = center, center_rank
+            for point in poll:
+                rank = search.seen.get(search.key(to_layout(point)), (2, 0.0))
+                if rank < best_rank:
+                    best_point, best_rank = point, rank
+            if best_rank < center_rank:
+                center, center_rank = best_point, best_rank
+            else:
+                step /= 2
+    finally:
+        if shared_env is not None and shared_env is not df_env:
+            env_arrays.release(shared_env)
+
+    report = search.report()
+    report['n_workers'] = n_workers
+    return report
+
+
+def crop_constraints(crop_params):
+    """Search constraints of a crop: its minimum daily light integral under the panels."""
+    if not crop_params or crop_params.get('dli_min') is None:
+        return ()
+    return (('dli_agri', '>=', float(crop_params['dli_min'])),)
+
+
+def run_continuous_optimization(df_env_base, system_params, crop_params, tol=0.05, bounds=DEFAULT_PITCH_BOUNDS,
+                                ground_resolution=core.DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    """Drop-in for core.run_optimization_analysis that searches pitch continuously instead of on a 0.5 m grid.
+
+    With crop_params, only pitches keeping the crop's dli_min under the panels are eligible.
+    """
+    report = optimize_pitch(df_env_base, system_params, bounds, tol, constraints=crop_constraints(crop_params),
+                            ground_resolution=ground_resolution, shading_method=shading_method, progress=progress)
+    optimal_pitch = report['best_layout']['pitch']
+
+    evaluated = sorted(report['history'], key=lambda entry: entry['layout']['pitch'])
+    graph_data = {
+        'optimization': {
+            'labels': [entry['layout']['pitch'] for entry in evaluated],
+            'datasets': [
+                # Unevenly spaced pitches, so the points carry their own x
+                {'label': 'Simulated Savings', 'data': [{'x': entry['layout']['pitch'], 'y': entry['results']['water_savings']} for entry in evaluated],
+                 'borderColor': 'blue', 'tension': 0.1}
+            ],
+            'optimal_pitch': optimal_pitch,
+            'max_savings': report['best_results']['water_savings']
+        }
+    }
+
+    single_pitch_results, single_pitch_graph_data = core._summarize_pitch(report['simulation_outputs'], optimal_pitch, progress)
+    graph_data.update(single_pitch_graph_data)
+
+    optimal_results = dict(single_pitch_results)
+    optimal_results.update({
+        'pitch': optimal_pitch, 'water_savings_percent': single_pitch_results['water_savings'],
+        'evaluations': report['evaluations'], 'wall_time_s': report['wall_time_s'],
+        'dli_min': (crop_params or {}).get('dli_min'), 'dli_feasible': report['feasible']
+    })
+    return optimal_results, graph_data
+
+
+def run_layout_optimization(df_env_base, system_params, crop_params, bounds=None, ground_resolution=core.DEFAULT_GROUND_RESOLUTION,
+                            shading_method='raster', progress=None):
+    """Optimization mode with layout_search: pitch, pivot height and max tilt searched together (optimize_layout)."""
+    df_env = env_arrays.as_env(df_env_base)
+    report = optimize_layout(df_env, system_params, bounds, constraints=crop_constraints(crop_params),
+                             ground_resolution=ground_resolution, shading_method=shading_method, progress=progress)
+    best_layout = report['best_layout']
+
+    evaluated = sorted(report['history'], key=lambda entry: entry['layout']['pitch'])
+    graph_data = {
+        'optimization': {
+            'labels': [entry['layout']['pitch'] for entry in evaluated],
+            'datasets': [
+                {'label': 'Simulated Savings', 'data': [{'x': entry['layout']['pitch'], 'y': entry['results']['water_savings']} for entry in evaluated],
+                 'borderColor': 'blue', 'tension': 0.1}
+            ],
+            'optimal_pitch': best_layout['pitch'],
+            'max_savings': report['best_results']['water_savings']
+        }
+    }
+
+    # The search keeps no hourly outputs (they stay in the workers); the best layout is simulated once more
+    simulation_outputs = _evaluate_layout(df_env, system_params, best_layout, ground_resolution, shading_method)
+    single_pitch_results, single_pitch_graph_data = core._summarize_pitch(simulation_outputs, best_layout['pitch'], progress)
+    graph_data.update(single_pitch_graph_data)
+
+    optimal_results = dict(single_pitch_results)
+    optimal_results.update({
+        'pitch': best_layout['pitch'], 'water_savings_percent': single_pitch_results['water_savings'], 'layout': best_layout,
+        'evaluations': report['evaluations'], 'wall_time_s': report['wall_time_s'],
+        'dli_min': (crop_params or {}).get('dli_min'), 'dli_feasible': report['feasible']
+    })
+    return optimal_results, graph_data
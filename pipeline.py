@@ -0,0 +1,260 @@
+# pipeline.py (v1.0)
+# L'pipeline dyal simulation_core ka graph dyal stages. Kol stage 3ndha cache dyalha, b key mn l'parametres
+# dyalha o mn keys dyal l'stages li 9bel menha; ila tbeddel ghir l'crop, ghir l'comments li kay3awdo yethasbo.
+#
+#   weather -> solar_position -> tracking -> shading -> et_agri -> simulation -> results / graphs -> summary -> comments
+#          \-> daily_weather -> et_open ----------------------/                  optimization -/
+
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import simulation_core as core
+import optimizer
+import metrics
+
+DEFAULT_STAGE_CACHE_SIZE = 32
+
+
+class StageFailed(Exception):
+    """A stage could not produce its output (e.g. no weather data); nothing is memoized."""
+
+
+class InvalidParameters(ValueError):
+    """A request value the simulation cannot run with (answered with a 400)."""
+
+
+class Stage:
+    def __init__(self, name, func, params=(), deps=(), cache_size=DEFAULT_STAGE_CACHE_SIZE):
+        self.name = name
+        self.func = func
+        self.params = tuple(params)
+        # deps may also be a function of the parameters, for stages whose inputs depend on the mode
+        self.deps = deps
+        self.cache_size = cache_size
+        self._outputs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dependencies(self, params):
+        return list(self.deps(params) if callable(self.deps) else self.deps)
+
+    def lookup(self, key):
+        with self._lock:
+            if key in self._outputs:
+                self._outputs.move_to_end(key)
+                return True, self._outputs[key]
+        return False, None
+
+    def remember(self, key, output):
+        with self._lock:
+            self._outputs[key] = output
+            while len(self._outputs) > self.cache_size:
+                self._outputs.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._outputs.clear()
+
+
+def _stage_key(stage, params, dep_keys):
+    own_params = {name: params.get(name) for name in stage.params}
+    description = json.dumps([stage.name, own_params, dep_keys], sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class Pipeline:
+    """Dependency graph of memoized stages.
+
+    A stage's key hashes its own parameters and its dependencies' keys, so editing one
+    parameter only invalidates the stages downstream of the stages that read it.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, func, params=(), deps=(), cache_size=DEFAULT_STAGE_CACHE_SIZE):
+        self.stages[name] = Stage(name, func, params, deps, cache_size)
+
+    def clear(self):
+        """Forgets every memoized output (e.g. for cold-start measurements)."""
+        for stage in self.stages.values():
+            stage.clear()
+
+    def stage_key(self, name, params, _keys=None):
+        """Key of a stage's output; it only depends on parameters, so it is known before anything runs."""
+        keys = {} if _keys is None else _keys
+        if name not in keys:
+            stage = self.stages[name]
+            dep_keys = [self.stage_key(dep_name, params, keys) for dep_name in stage.dependencies(params)]
+            keys[name] = _stage_key(stage, params, dep_keys)
+        return keys[name]
+
+    def run(self, params, targets, progress=None, provided=None):
+        """Evaluates `targets`, running only the stages whose memoized output is missing.
+
+        A stage found in its cache is returned without even looking at its dependencies.
+        `provided` maps stage names to outputs obtained elsewhere (e.g. a persistent result
+        cache). Returns ({stage: output}, report); the report lists every stage touched as
+        'recomputed', 'reused' or 'provided', with the time spent on it.
+        """
+        provided = provided or {}
+        keys, outputs, report = {}, {}, []
+
+        def evaluate(name):
+            if name in outputs:
+                return outputs[name]
+            stage = self.stages[name]
+            key = self.stage_key(name, params, keys)
+            start_time = time.perf_counter()
+            if name in provided:
+                status, output = 'provided', provided[name]
+                stage.remember(key, output)
+            else:
+                found, output = stage.lookup(key)
+                status = 'reused'
+                if not found:
+                    inputs = {dep_name: evaluate(dep_name) for dep_name in stage.dependencies(params)}
+                    # Time spent in the dependencies is reported on their own rows
+                    start_time = time.perf_counter()
+                    core._report_progress(progress, name)
+                    # The core's own timed blocks inside a stage are recorded as its breakdown ('optimization.shading')
+                    with metrics.timed(name):
+                        output = stage.func(inputs, {param: params.get(param) for param in stage.params}, progress)
+                    stage.remember(key, output)
+                    status = 'recomputed'
+            outputs[name] = output
+            seconds = time.perf_counter() - start_time
+            report.append({'stage': name, 'status': status, 'seconds': seconds})
+            metrics.PIPELINE_STAGES.inc(stage=name, status=status)
+            return output
+
+        for target in targets:
+            evaluate(target)
+        return {target: outputs[target] for target in targets}, report
+
+
+# --- Stages of the simulation ---
+SITE_PARAMS = ('latitude', 'longitude', 'altitude')
+# The weather stage also keys on the version of the cached TMY, so a refreshed or expired entry is refetched
+WEATHER_PARAMS = SITE_PARAMS + ('weather_version',)
+
+def _stage_weather(inputs, params, progress):
+    env = core.fetch_env(params['latitude'], params['longitude'], params['altitude'])
+    if env is None:
+        raise StageFailed("Error fetching data from PVGIS.")
+    return env
+
+def _stage_solar_position(inputs, params, progress):
+    env = inputs['weather']
+    return np.asarray(env['sun_elevation'], dtype=float), np.asarray(env['sun_azimuth'], dtype=float)
+
+def _stage_tracking(inputs, params, progress):
+    return core._compute_panel_tilt(inputs['weather'], params, params['pitch'])
+
+def _stage_shading(inputs, params, progress):
+    sun_elevation, sun_azimuth = inputs['solar_position']
+    shadow_start, shadow_end = core._compute_shadow_intervals(inputs['tracking'], sun_elevation, sun_azimuth, params, params['pitch'])
+    shaded_fraction = core._shaded_fraction(shadow_start, shadow_end, params['pitch'], params['shading_method'], params['ground_resolution'])
+    env = inputs['weather']
+    ghi = np.asarray(env['ghi'], dtype=float)
+    dhi = np.asarray(env['dhi'], dtype=float)
+    return dhi + (ghi - dhi) * (1 - shaded_fraction)
+
+def _stage_daily_weather(inputs, params, progress):
+    return core._aggregate_daily_weather(inputs['weather'])
+
+def _stage_et_open(inputs, params, progress):
+    daily_df = inputs['daily_weather']
+    return core._penman_monteith(daily_df, daily_df['sol_rad_open'], params)
+
+def _stage_et_agri(inputs, params, progress):
+    sol_rad_agri = inputs['weather'].daily(inputs['shading'] * 3600 / 1_000_000)
+    return core._penman_monteith(inputs['daily_weather'], sol_rad_agri, params)
+
+def _stage_simulation(inputs, params, progress):
+    df_sim = core._simulation_frame(inputs['weather'], inputs['tracking'], inputs['shading'])
+    et_open, et_agri = inputs['et_open'], inputs['et_agri']
+    total_et_open, total_et_agri = et_open.sum(), et_agri.sum()
+    water_savings_percent = ((total_et_open - total_et_agri) / total_et_open) * 100 if total_et_open > 0 else 0
+    return df_sim, water_savings_percent, total_et_open, total_et_agri, et_open, et_agri
+
+def _stage_results(inputs, params, progress):
+    return core._pitch_results(inputs['simulation'])
+
+def _stage_graphs(inputs, params, progress):
+    df_sim, _, _, _, et_open_series, et_agri_series = inputs['simulation']
+    return core._prepare_graph_data({'df_sim': df_sim, 'et_open': et_open_series, 'et_agri': et_agri_series}, params['pitch'])
+
+def _stage_optimization(inputs, params, progress):
+    if params['layout_bounds']:
+        return optimizer.run_layout_optimization(inputs['weather'], params, params['crop_params'], bounds=params['layout_bounds'],
+                                                 ground_resolution=params['ground_resolution'],
+                                                 shading_method=params['shading_method'], progress=progress)
+    if params['pitch_tolerance']:
+        return optimizer.run_continuous_optimization(inputs['weather'], params, params['crop_params'], tol=params['pitch_tolerance'],
+                                                     ground_resolution=params['ground_resolution'],
+                                                     shading_method=params['shading_method'], progress=progress)
+    return core.run_optimization_analysis(inputs['weather'], params, None, params['ground_resolution'], params['shading_method'], progress)
+
+def _stage_summary(inputs, params, progress):
+    if params['mode'] == 'Optimization':
+        return inputs['optimization']
+    return inputs['results'], inputs['graphs']
+
+
+def build_simulation_pipeline():
+    simulation_pipeline = Pipeline()
+    simulation_pipeline.add_stage('weather', _stage_weather, WEATHER_PARAMS, cache_size=8)
+    simulation_pipeline.add_stage('solar_position', _stage_solar_position, deps=['weather'], cache_size=8)
+    simulation_pipeline.add_stage('tracking', _stage_tracking, SITE_PARAMS + ('panel_width', 'axis_azimuth', 'max_tilt', 'pitch'), ['weather', 'solar_position'], cache_size=64)
+    simulation_pipeline.add_stage('shading', _stage_shading, ('panel_width', 'pivot_height', 'axis_azimuth', 'pitch', 'ground_resolution', 'shading_method'),
+                                  ['weather', 'solar_position', 'tracking'], cache_size=64)
+    simulation_pipeline.add_stage('daily_weather', _stage_daily_weather, deps=['weather'], cache_size=8)
+    simulation_pipeline.add_stage('et_open', _stage_et_open, ('altitude', 'latitude'), ['daily_weather'], cache_size=8)
+    simulation_pipeline.add_stage('et_agri', _stage_et_agri, ('altitude', 'latitude'), ['weather', 'daily_weather', 'shading'], cache_size=64)
+    simulation_pipeline.add_stage('simulation', _stage_simulation, deps=['weather', 'tracking', 'shading', 'et_open', 'et_agri'], cache_size=8)
+    simulation_pipeline.add_stage('results', _stage_results, deps=['simulation'], cache_size=64)
+    simulation_pipeline.add_stage('graphs', _stage_graphs, ('pitch',), ['simulation'], cache_size=64)
+    simulation_pipeline.add_stage('optimization', _stage_optimization,
+                                  SITE_PARAMS + ('panel_width', 'pivot_height', 'axis_azimuth', 'max_tilt', 'ground_resolution', 'shading_method', 'pitch_tolerance', 'layout_bounds', 'crop_params'),
+                                  ['weather'], cache_size=16)
+    simulation_pipeline.add_stage('summary', _stage_summary, ('mode',),
+                                  lambda params: ['optimization'] if params['mode'] == 'Optimization' else ['results', 'graphs'], cache_size=64)
+    return simulation_pipeline
+
+
+def pipeline_params(request_params):
+    """Flattens a /simulate payload into the parameter namespace the stages read from.
+
+    Raises InvalidParameters for values the simulation cannot run with.
+    """
+    try:
+        ground_resolution, shading_method = core.shading_options(request_params.get('ground_resolution', core.DEFAULT_GROUND_RESOLUTION),
+                                                                 request_params.get('shading_method', 'raster'))
+        pitch_tolerance = optimizer.pitch_tolerance(request_params.get('pitch_tolerance'))
+        # layout_search: pitch, pivot_height and max_tilt searched jointly instead of the pitch alone
+        layout_bounds = optimizer.layout_bounds(request_params.get('layout_bounds')) if request_params.get('layout_search') else None
+    except ValueError as e:
+        raise InvalidParameters(str(e))
+    params = dict(request_params['sys_params'])
+    weather_version = core.weather_version(params['latitude'], params['longitude'], params['altitude'])
+    if weather_version is None:
+        # Nothing valid cached yet: this run fetches, and what it memoizes must not be reused once the fetch is stored
+        weather_version = f"uncached-{time.time_ns()}"
+    custom_pitch = request_params.get('custom_pitch')
+    params.update(
+        weather_version=weather_version,
+        mode='Optimization' if request_params['mode'] == 'Optimization' else 'Custom',
+        pitch=float(custom_pitch) if isinstance(custom_pitch, (int, float)) else custom_pitch,
+        pitch_tolerance=pitch_tolerance,
+        layout_bounds=layout_bounds if request_params['mode'] == 'Optimization' else None,
+        ground_resolution=ground_resolution,
+        shading_method=shading_method,
+        crop_params=request_params['crop_params'],
+        lang=request_params.get('lang', 'en')
+    )
+    if params['mode'] == 'Optimization':
+        params['pitch'] = None
+    return params
@@ -0,0 +1,170 @@
+# result_cache.py (v1.0)
+# Cache dyal resultats dyal /simulate, b hash dyal l'parametres li kaybeddlo l'physique (machi crop wla lang).
+# Tier 1: LRU f memoire; tier 2 (optional): fichiers .json.gz f dossier mcharek bin gunicorn workers.
+
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import simulation_core as core
+
+# Bump when a change to simulation_core alters the numbers, so stale entries stop matching
+PHYSICS_VERSION = 1
+
+MEMORY_MAX_BYTES = int(os.environ.get('AGRIVOLTAIC_RESULT_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+DISK_DIR = os.environ.get('AGRIVOLTAIC_RESULT_CACHE_DIR')
+DISK_MAX_BYTES = int(os.environ.get('AGRIVOLTAIC_RESULT_CACHE_DISK_BYTES', 1024 * 1024 * 1024))
+
+
+def _canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=float)
+
+
+def _normalize_numbers(params):
+    # 5 and 5.0 describe the same layout
+    return {key: float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+            for key, value in params.items()}
+
+
+def physics_key(params):
+    """Hash of the request fields that change results/graph_data; apart from the dli_min of the continuous
+    optimizations, crop_params and lang only feed the comments.
+
+    The version of the site's cached weather is part of the key, which is None while that weather
+    is not cached (nothing to reuse). Expects a payload pipeline.pipeline_params accepted (valid shading options).
+    """
+    sys_params = params['sys_params']
+    weather_version = core.weather_version(sys_params['latitude'], sys_params['longitude'], sys_params['altitude'])
+    if weather_version is None:
+        # The weather is not cached yet, so nothing can be said about the result it will give
+        return None
+    relevant = {'version': PHYSICS_VERSION, 'weather_version': weather_version, 'sys_params': _normalize_numbers(sys_params)}
+    relevant['ground_resolution'], relevant['shading_method'] = core.shading_options(
+        params.get('ground_resolution', core.DEFAULT_GROUND_RESOLUTION), params.get('shading_method', 'raster'))
+    if params['mode'] == 'Optimization':
+        relevant['mode'] = 'Optimization'
+        relevant['pitch_tolerance'] = float(params['pitch_tolerance']) if params.get('pitch_tolerance') else None
+        relevant['layout_bounds'] = params.get('layout_bounds') if params.get('layout_search') else None
+        if relevant['pitch_tolerance'] or params.get('layout_search'):
+            # The continuous searches only consider layouts meeting the crop's dli_min
+            dli_min = (params.get('crop_params') or {}).get('dli_min')
+            relevant['dli_min'] = float(dli_min) if dli_min is not None else None
+    else:
+        relevant['mode'] = 'Custom'
+        custom_pitch = params.get('custom_pitch')
+        relevant['custom_pitch'] = float(custom_pitch) if isinstance(custom_pitch, (int, float)) else custom_pitch
+    return hashlib.sha256(_canonical_json(relevant).encode()).hexdigest()
+
+
+def response_etag(params):
+    """Validator for the full response body: the physics key plus the inputs of the comments."""
+    comment_inputs = {'physics': physics_key(params), 'crop_params': params.get('crop_params'), 'lang': params.get('lang', 'en')}
+    return hashlib.sha256(_canonical_json(comment_inputs).encode()).hexdigest()[:32]
+
+
+class ResultCache:
+    """Two-tier cache of serialized {'results', 'graph_data'} entries.
+
+    Entries are kept as JSON bytes, so every hit hands out fresh objects and the memory
+    tier can be bounded by size. A None key (see physics_key) is never stored nor found.
+    """
+
+    def __init__(self, memory_max_bytes=MEMORY_MAX_BYTES, disk_dir=DISK_DIR, disk_max_bytes=DISK_MAX_BYTES):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json.gz")
+
+    def _remember(self, key, payload):
+        with self._lock:
+            if key in self._entries:
+                self._memory_bytes -= len(self._entries.pop(key))
+            self._entries[key] = payload
+            self._memory_bytes += len(payload)
+            while self._memory_bytes > self.memory_max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def contains(self, key):
+        if key is None:
+            return False
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.disk_dir is not None and os.path.exists(self._disk_path(key))
+
+    def get(self, key):
+        if key is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.hits['memory'] += 1
+                return json.loads(payload)
+
+        if self.disk_dir is not None:
+            try:
+                with gzip.open(self._disk_path(key), 'rb') as f:
+                    payload = f.read()
+                os.utime(self._disk_path(key))
+            except (OSError, EOFError):
+                payload = None
+            if payload is not None:
+                self._remember(key, payload)
+                with self._lock:
+                    self.hits['disk'] += 1
+                return json.loads(payload)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key is None:
+            return
+        payload = _canonical_json(value).encode()
+        self._remember(key, payload)
+        if self.disk_dir is None:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            with os.fdopen(file_descriptor, 'wb') as f:
+                f.write(gzip.compress(payload))
+            os.replace(temp_path, self._disk_path(key))
+            self._evict_disk()
+        except OSError as e:
+            print(f"WARNING: could not write the result cache: {e}")
+
+    def _evict_disk(self):
+        entries = [(entry.path, entry.stat()) for entry in os.scandir(self.disk_dir) if entry.name.endswith('.json.gz')]
+        total_bytes = sum(stat.st_size for _, stat in entries)
+        for path, stat in sorted(entries, key=lambda item: item[1].st_mtime):
+            if total_bytes <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= stat.st_size
+            except FileNotFoundError:
+                pass
+
+    def info(self):
+        with self._lock:
+            return {'hits': dict(self.hits), 'misses': self.misses, 'entries': len(self._entries),
+                    'memory_bytes': self._memory_bytes, 'disk_dir': self.disk_dir}
+
+
+default_cache = ResultCache()
@@ -5,20 +5,39 @@ import pandas as pd
 import numpy as np
 import pvlib
 import pyet
+import weather_cache
+import solar_geometry
+import env_arrays
+import metrics
 import os
+import time
 
-def fetch_pvgis_data(latitude, longitude, altitude):
+# --- [MODIFIED v1.4] ---
+# L'TMY kayt7et f cache local (weather_cache); f offline mode kankhedmo ghir mn l'cache
+def fetch_pvgis_data(latitude, longitude, altitude, offline=None, refresh=False):
+    offline = weather_cache.OFFLINE if offline is None else offline
+    key = weather_cache.site_key(latitude, longitude, altitude)
+    # refresh: fetch even if cached; the cached copy is only replaced once the new one is in
+    df_env = weather_cache.load(key, allow_stale=offline) if not refresh or offline else None
+    if df_env is not None:
+        metrics.PVGIS_REQUESTS.inc(outcome='cache_hit')
+        return df_env
+    if offline:
+        metrics.PVGIS_REQUESTS.inc(outcome='offline_miss')
+        print(f"CRITICAL ERROR fetching PVGIS data: offline mode and no cached weather for {key}")
+        return None
+
+    # The cached entry is shared by every site that rounds to this key, so it's computed for the key itself
+    latitude, longitude, altitude = key
     try:
-        pvgis_output = pvlib.iotools.get_pvgis_tmy(latitude, longitude, map_variables=True)
+        with metrics.timed('pvgis_fetch'):
+            pvgis_output = pvlib.iotools.get_pvgis_tmy(latitude, longitude, map_variables=True)
         weather = pvgis_output[0]
         clean_index = pd.date_range(start='2022-01-01 00:00', end='2022-12-31 23:00', freq='h', tz='Etc/GMT')
         weather = weather.iloc[:len(clean_index)].reset_index(drop=True)
         weather.index = clean_index
 
-        solar_position = pvlib.solarposition.get_solarposition(
-            time=weather.index, latitude=latitude, longitude=longitude, altitude=altitude,
-            temperature=weather.get('temp_air', 15)
-        )
+        sun_elevation, sun_azimuth = solar_geometry.solar_position(latitude, longitude, altitude, clean_index[0].year)
         df_env = pd.DataFrame(index=weather.index)
         df_env['ghi'] = weather.get('ghi', np.nan)
         df_env['dhi'] = weather.get('dhi', np.nan)
@@ -26,95 +45,358 @@ def fetch_pvgis_data(latitude, longitude, altitude):
         df_env['temp_air'] = weather.get('temp_air', np.nan)
         df_env['wind_speed'] = weather.get('wind_speed', np.nan)
         df_env['relative_humidity'] = weather.get('relative_humidity', np.nan)
-        df_env['sun_elevation'] = solar_position['elevation']
-        df_env['sun_azimuth'] = solar_position['azimuth']
-        return df_env.ffill().bfill()
+        df_env['sun_elevation'] = sun_elevation
+        df_env['sun_azimuth'] = sun_azimuth
+        df_env = df_env.ffill().bfill()
     except Exception as e:
         print(f"CRITICAL ERROR fetching PVGIS data: {e}")
+        metrics.PVGIS_ERRORS.inc()
+        # An expired copy still beats failing the request while PVGIS is down
+        df_env = weather_cache.load(key, allow_stale=True)
+        metrics.PVGIS_REQUESTS.inc(outcome='error' if df_env is None else 'stale_fallback')
+        return df_env
+
+    metrics.PVGIS_REQUESTS.inc(outcome='fetched')
+
+    try:
+        weather_cache.store(key, df_env)
+    except OSError as e:
+        print(f"WARNING: could not write the weather cache: {e}")
+    return df_env
+
+# --- [MODIFIED v1.8] ---
+# L'simulation kat9ra l'weather b EnvArrays (env_arrays.py): float32, read-only, bla copie dyal DataFrame f kol pitch
+def weather_version(latitude, longitude, altitude, offline=None):
+    """Version (fetch time) of a site's cached weather, or None while nothing valid is cached; memoized results key on it."""
+    offline = weather_cache.OFFLINE if offline is None else offline
+    return weather_cache.fetched_at(weather_cache.site_key(latitude, longitude, altitude), allow_stale=offline)
+
+def fetch_env(latitude, longitude, altitude, offline=None):
+    """fetch_pvgis_data as an EnvArrays; with AGRIVOLTAIC_SHARED_WEATHER, one copy per machine in shared memory."""
+    key = weather_cache.site_key(latitude, longitude, altitude)
+    offline = weather_cache.OFFLINE if offline is None else offline
+    if env_arrays.SHARED_WEATHER:
+        # The segment is only valid for the cache entry it was made from: an expired or refreshed entry misses
+        version = weather_version(latitude, longitude, altitude, offline)
+        env = env_arrays.lookup_shared(key, version) if version is not None else None
+        if env is not None:
+            metrics.PVGIS_REQUESTS.inc(outcome='cache_hit')
+            return env
+    df_env = fetch_pvgis_data(latitude, longitude, altitude, offline)
+    if df_env is None:
         return None
+    if env_arrays.SHARED_WEATHER:
+        version = weather_cache.fetched_at(key, allow_stale=True)
+        if version is not None:
+            return env_arrays.publish_shared(key, version, df_env)
+    return env_arrays.EnvArrays.from_frame(df_env)
+
+# --- [MODIFIED v1.2] ---
+# Shading engine vectorized: kol sa3at l'3am kathseb f pass wa7ed dyal NumPy
+DEFAULT_GROUND_RESOLUTION = 0.1
+SHADING_METHODS = ('raster', 'analytic')
+# Finer than 1 cm the raster grows by the gigabyte for no visible change; coarser than 1 m it misses the rows
+GROUND_RESOLUTION_BOUNDS = (0.01, 1.0)
+
+def shading_options(ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster'):
+    """(ground_resolution, shading_method) of a request, checked and normalized; raises ValueError."""
+    if shading_method not in SHADING_METHODS:
+        raise ValueError(f"Unknown shading method: {shading_method}. Expected one of {', '.join(SHADING_METHODS)}.")
+    low, high = GROUND_RESOLUTION_BOUNDS
+    try:
+        ground_resolution = float(ground_resolution)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid ground resolution: {ground_resolution!r}.")
+    if not low <= ground_resolution <= high:
+        raise ValueError(f"The ground resolution must be between {low} and {high} m.")
+    return ground_resolution, shading_method
+
+def _compute_shadow_intervals(panel_tilt, sun_elevation, sun_azimuth, system_params, pitch):
+    """Returns the (start, end) ground coordinates of the row shadow for every hour.
+
+    All angle inputs are arrays in degrees; night hours (sun below the horizon) come back as NaN.
+    """
+    tilt = np.radians(panel_tilt)
+    sun_ele = np.radians(sun_elevation)
+    sun_azi = np.radians(sun_azimuth)
+
+    pivot_x = pitch / 2
+    panel_half_width = 0.5 * system_params['panel_width']
+    x1 = pivot_x - panel_half_width * np.cos(tilt)
+    y1 = system_params['pivot_height'] + panel_half_width * np.sin(tilt)
+    x2 = pivot_x + panel_half_width * np.cos(tilt)
+    y2 = system_params['pivot_height'] - panel_half_width * np.sin(tilt)
+
+    shadow_proj_factor = np.sin(sun_azi - np.radians(system_params['axis_azimuth'] - 180)) / np.tan(sun_ele + 1e-6)
+    shadow_x1 = x1 - y1 * shadow_proj_factor
+    shadow_x2 = x2 - y2 * shadow_proj_factor
+
+    is_day = sun_elevation > 0
+    start = np.where(is_day, np.minimum(shadow_x1, shadow_x2), np.nan)
+    end = np.where(is_day, np.maximum(shadow_x1, shadow_x2), np.nan)
+    return start, end
 
-def _run_shading_and_et_simulation(df_env, system_params, pitch):
+def _shaded_fraction_raster(shadow_start, shadow_end, pitch, ground_resolution=DEFAULT_GROUND_RESOLUTION):
+    """Fraction of the ground points np.arange(0, pitch, ground_resolution) inside each shadow.
+
+    Same result as averaging a 0/1 (hours x ground points) mask, but the points are counted with
+    a binary search on the sorted grid, so a finer resolution doesn't cost a bigger array.
+    """
+    ground_x = np.arange(0, pitch, ground_resolution)
+    is_day = ~np.isnan(shadow_start)
+    first = np.searchsorted(ground_x, np.where(is_day, shadow_start, np.inf), side='left')
+    last = np.searchsorted(ground_x, np.where(is_day, shadow_end, -np.inf), side='right')
+    return np.clip(last - first, 0, None) / len(ground_x)
+
+def _shaded_fraction_analytic(shadow_start, shadow_end, pitch):
+    """Exact shaded fraction of the periodic row pattern, without a ground raster.
+
+    Every row casts the same shadow shifted by one pitch, so on the strip [0, pitch) the
+    shadow wraps around modulo pitch. Folding [start, end] into the strip gives at most two
+    pieces, [start mod pitch, pitch) and [0, end - k*pitch), and they only overlap once the
+    shadow is longer than a full pitch; the merged length is therefore min(end - start, pitch).
+    """
+    shadow_length = np.nan_to_num(shadow_end - shadow_start, nan=0.0)
+    return np.minimum(shadow_length, pitch) / pitch
+
+def _shaded_fraction(shadow_start, shadow_end, pitch, shading_method='raster', ground_resolution=DEFAULT_GROUND_RESOLUTION):
+    if shading_method == 'raster':
+        if np.ndim(pitch):
+            return np.vstack([
+                _shaded_fraction_raster(start, end, row_pitch, ground_resolution)
+                for start, end, row_pitch in zip(shadow_start, shadow_end, np.ravel(pitch))
+            ])
+        return _shaded_fraction_raster(shadow_start, shadow_end, pitch, ground_resolution)
+    if shading_method == 'analytic':
+        return _shaded_fraction_analytic(shadow_start, shadow_end, pitch)
+    raise ValueError(f"Unknown shading method '{shading_method}', expected one of {SHADING_METHODS}.")
+
+# --- [MODIFIED v1.3] ---
+# Kolchi li ma kaytbeddelch m3a l'pitch kaythseb mrra wa7da, o l'pitches kamlin kaytsimulaw f (pitch x hour) array
+def _compute_panel_tilt(df_env, system_params, pitch):
+    env = env_arrays.as_env(df_env)
     gcr = system_params['panel_width'] / pitch
+    # [MODIFIED v1.5] Weather from fetch_pvgis_data carries the cached sun position of its site key,
+    # so the tracker angles can come from the geometry cache too
+    latitude, longitude, altitude = weather_cache.site_key(system_params['latitude'], system_params['longitude'], system_params['altitude'])
+    year = env.start.year
+    sun_elevation, sun_azimuth = solar_geometry.solar_position(latitude, longitude, altitude, year)
+    if (len(env) == len(sun_elevation)
+            and np.array_equal(env['sun_elevation'], sun_elevation.astype(env_arrays.DTYPE))
+            and np.array_equal(env['sun_azimuth'], sun_azimuth.astype(env_arrays.DTYPE))):
+        return solar_geometry.tracker_tilt(latitude, longitude, altitude, year, system_params['axis_azimuth'], system_params['max_tilt'], gcr)
+
     tracking_data = pvlib.tracking.singleaxis(
-        apparent_zenith=df_env['sun_elevation'].apply(lambda x: 90 - x),
-        apparent_azimuth=df_env['sun_azimuth'],
+        90 - np.asarray(env['sun_elevation'], dtype=float), np.asarray(env['sun_azimuth'], dtype=float),
         axis_azimuth=system_params['axis_azimuth'],
         max_angle=system_params['max_tilt'],
         backtrack=True, gcr=gcr
     )
-    df_env['panel_tilt'] = tracking_data['surface_tilt'].fillna(0)
+    return np.nan_to_num(np.asarray(tracking_data['surface_tilt'], dtype=float), nan=0.0)
+
+def _aggregate_daily_weather(df_env):
+    env = env_arrays.as_env(df_env)
+    temp_air = env['temp_air']
+    return pd.DataFrame({
+        'tmin': env.daily(temp_air, 'min'), 'tmax': env.daily(temp_air, 'max'), 'tmean': env.daily(temp_air, 'mean'),
+        'wind': env.daily(env['wind_speed'], 'mean'), 'rh': env.daily(env['relative_humidity'], 'mean'),
+        'sol_rad_open': env.daily(np.asarray(env['ghi'], dtype=float) * 3600 / 1_000_000)
+    }, index=env.calendar()['days'])
+
+# [MODIFIED v1.7] FAO-56 Penman-Monteith in plain NumPy, same equations and defaults as pyet.pm
+STEFAN_BOLTZMANN_DAY = 4.903e-9
+AIR_SPECIFIC_HEAT = 0.001013
+ALBEDO = 0.23
+SURFACE_RESISTANCE = 100 / (0.5 * 0.12 * 24)  # r_l / LAI_eff of the 0.12 m reference grass
+
+def _saturation_vapor_pressure(temperature):
+    return 0.6108 * np.exp(17.27 * temperature / (temperature + 237.3))
+
+def _penman_monteith_terms(daily_df, system_params):
+    """Every term of the PM equation that does not depend on the solar radiation, one value per day.
+
+    They are computed once per site and shared by the open field and all the pitches.
+    """
+    tmean, tmax, tmin = (daily_df[column].to_numpy(dtype=float) for column in ('tmean', 'tmax', 'tmin'))
+    wind = daily_df['wind'].to_numpy(dtype=float)
+    elevation = system_params['altitude']
+    # pyet expects radians; the degrees are passed through as before so the totals do not move
+    latitude = system_params['latitude']
+
+    pressure = 101.3 * ((293 - 0.0065 * elevation) / 293) ** 5.26
+    gamma = 0.000665 * pressure
+    slope = 4098 * _saturation_vapor_pressure(tmean) / (tmean + 237.3) ** 2
+    latent_heat = 2.501 - 0.002361 * tmean
+    es = (_saturation_vapor_pressure(tmax) + _saturation_vapor_pressure(tmin)) / 2
+    ea = daily_df['rh'].to_numpy(dtype=float) / 100 * es
+    res_aero = 208 / np.where(wind == 0, 0.0001, wind)
+    den = latent_heat * (slope + gamma * (1 + SURFACE_RESISTANCE / res_aero))
+    rho_air = 3.486 * pressure / ((273.16 + tmean) / (1 - 0.378 * ea / pressure))
+
+    day = daily_df.index.dayofyear.to_numpy()
+    inverse_distance = 1 + 0.033 * np.cos(2 * np.pi / 365 * day)
+    declination = 0.409 * np.sin(2 * np.pi / 365 * day - 1.39)
+    sunset_angle = np.arccos(np.clip(-np.tan(latitude) * np.tan(declination), -1, 1))
+    extraterrestrial = 118.08 / 3.141592654 * inverse_distance * (
+        sunset_angle * np.sin(latitude) * np.sin(declination) + np.cos(latitude) * np.cos(declination) * np.sin(sunset_angle))
+    clear_sky = (0.75 + 2e-5 * elevation) * extraterrestrial
+    clear_sky = np.where(clear_sky == 0, 0.001, clear_sky)
+
+    return {
+        'index': daily_df.index,
+        'slope_over_den': slope / den,
+        'aerodynamic': rho_air * AIR_SPECIFIC_HEAT * 86400 * (es - ea) / res_aero / den,
+        'clear_sky': clear_sky,
+        'longwave': STEFAN_BOLTZMANN_DAY * ((tmax + 273.16) ** 4 + (tmin + 273.16) ** 4) / 2 * (0.34 - 0.14 * np.sqrt(ea))
+    }
+
+def _penman_monteith_matrix(terms, sol_rad):
+    """Daily ET (mm) for a (days,) or (days, scenarios) matrix of solar radiation (MJ/m2/day)."""
+    sol_rad = np.asarray(sol_rad, dtype=float)
+    column = (slice(None),) + (np.newaxis,) * (sol_rad.ndim - 1)
+    relative_radiation = np.clip(sol_rad / terms['clear_sky'][column], 0.3, 1)
+    net_longwave = terms['longwave'][column] * np.clip(1.35 * relative_radiation - 0.35, 0.05, 1)
+    net_radiation = (1 - ALBEDO) * sol_rad - net_longwave
+    et = terms['slope_over_den'][column] * net_radiation + terms['aerodynamic'][column]
+    return np.where(et < 0, 0.0, et)
+
+def _penman_monteith(daily_df, sol_rad, system_params, terms=None):
+    terms = _penman_monteith_terms(daily_df, system_params) if terms is None else terms
+    return pd.Series(_penman_monteith_matrix(terms, sol_rad), index=terms['index'], name='Penman_Monteith')
+
+def _report_progress(progress, stage, **detail):
+    # [MODIFIED v1.6] Optional callback used by the job API; it may raise to cancel the run
+    if progress is not None:
+        progress(stage, **detail)
+
+def _pitch_geometry(df_env, system_params, pitches, ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    """Tracker angles and shaded fractions of several pitches (float32, one row per pitch).
+
+    They depend on the sun and the layout only, so one geometry serves any weather on the same
+    time axis: every pitch of a sweep, or every year of a weather ensemble.
+    """
+    env = env_arrays.as_env(df_env)
+    pitches = np.atleast_1d(np.asarray(pitches, dtype=float))
+    sun_elevation = np.asarray(env['sun_elevation'], dtype=float)
+    sun_azimuth = np.asarray(env['sun_azimuth'], dtype=float)
+
+    # One pitch at a time, so the float64 temporaries stay one row of hours long
+    panel_tilt = np.empty((len(pitches), len(env)), dtype=env_arrays.DTYPE)
+    shaded_fraction = np.empty_like(panel_tilt)
+    for i, pitch in enumerate(pitches):
+        with metrics.timed('tracking'):
+            panel_tilt[i] = pitch_tilt = _compute_panel_tilt(env, system_params, pitch)
+        _report_progress(progress, 'tracking', pitch=float(pitch), done=i + 1, total=len(pitches))
+        with metrics.timed('shading'):
+            shadow_start, shadow_end = _compute_shadow_intervals(pitch_tilt, sun_elevation, sun_azimuth, system_params, pitch)
+            shaded_fraction[i] = _shaded_fraction(shadow_start, shadow_end, pitch, shading_method, ground_resolution)
+    return {'pitches': pitches, 'panel_tilt': panel_tilt, 'shaded_fraction': shaded_fraction}
+
+def _simulate_pitches(df_env, system_params, pitches, ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None, geometry=None):
+    """Simulates several pitches at once; per-pitch outputs are stacked along the first axis.
+
+    df_env (an EnvArrays or a DataFrame) is only read, so the same one is shared by every pitch of a sweep.
+    The weather is float32; the arithmetic is done in float64. A `geometry` from _pitch_geometry
+    (its pitches replace `pitches`) skips the tracking and shading steps.
+    """
+    env = env_arrays.as_env(df_env)
+    if geometry is None:
+        geometry = _pitch_geometry(env, system_params, pitches, ground_resolution, shading_method, progress)
+    pitches = geometry['pitches']
+    ghi = np.asarray(env['ghi'], dtype=float)
+    dhi = np.asarray(env['dhi'], dtype=float)
+
+    # Only the float32 rows and the daily radiation sums are kept for the whole sweep
+    avg_ghi_agrivoltaic = np.empty((len(pitches), len(env)), dtype=env_arrays.DTYPE)
+    sol_rad_agri = np.empty((len(env.calendar()['day_start']), len(pitches)))
+    with metrics.timed('shading'):
+        for i in range(len(pitches)):
+            pitch_ghi = dhi + (ghi - dhi) * (1 - np.asarray(geometry['shaded_fraction'][i], dtype=float))
+            sol_rad_agri[:, i] = env.daily(pitch_ghi * 3600 / 1_000_000)
+            avg_ghi_agrivoltaic[i] = pitch_ghi
+    _report_progress(progress, 'shading', done=len(pitches), total=len(pitches))
+
+    with metrics.timed('et'):
+        daily_df = _aggregate_daily_weather(env)
+
+        # One (days x pitches) pass; only the radiation terms differ between the open field and the pitches
+        et_terms = _penman_monteith_terms(daily_df, system_params)
+        et_open_field = _penman_monteith(daily_df, daily_df['sol_rad_open'], system_params, et_terms)
+        et_matrix = _penman_monteith_matrix(et_terms, sol_rad_agri)
+        et_agrivoltaic = [pd.Series(et_matrix[:, i], index=daily_df.index, name='Penman_Monteith') for i in range(len(pitches))]
+    _report_progress(progress, 'et', done=len(pitches), total=len(pitches))
 
-    ground_x = np.arange(0, pitch, 0.1)
-    pivot_x = pitch / 2
-    is_shaded = pd.DataFrame(0.0, index=df_env.index, columns=ground_x)
-
-    for hour in df_env[df_env['sun_elevation'] > 0].index:
-        tilt = np.radians(df_env.loc[hour, 'panel_tilt'])
-        sun_ele = np.radians(df_env.loc[hour, 'sun_elevation'])
-        sun_azi = np.radians(df_env.loc[hour, 'sun_azimuth'])
-        
-        panel_half_width = 0.5 * system_params['panel_width']
-        x1 = pivot_x - panel_half_width * np.cos(tilt)
-        y1 = system_params['pivot_height'] + panel_half_width * np.sin(tilt)
-        x2 = pivot_x + panel_half_width * np.cos(tilt)
-        y2 = system_params['pivot_height'] - panel_half_width * np.sin(tilt)
-
-        shadow_proj_factor = np.sin(sun_azi - np.radians(system_params['axis_azimuth']-180)) / np.tan(sun_ele + 1e-6)
-        shadow_x1 = x1 - y1 * shadow_proj_factor
-        shadow_x2 = x2 - y2 * shadow_proj_factor
-
-        start, end = min(shadow_x1, shadow_x2), max(shadow_x1, shadow_x2)
-        is_shaded.loc[hour, (ground_x >= start) & (ground_x <= end)] = 1.0
-
-    ghi = df_env['ghi'].to_numpy()[:, np.newaxis]
-    dhi = df_env['dhi'].to_numpy()[:, np.newaxis]
-    ground_irradiance = dhi + (ghi - dhi) * (1 - is_shaded)
-    df_env['avg_ghi_agrivoltaic'] = ground_irradiance.mean(axis=1)
-
-    daily_df = df_env.resample('D').agg({
-        'temp_air': ['min', 'max', 'mean'], 'wind_speed': 'mean', 'relative_humidity': 'mean'
-    })
-    daily_df.columns = ['tmin', 'tmax', 'tmean', 'wind', 'rh']
-    daily_df['sol_rad_open'] = (df_env['ghi'] * 3600 / 1_000_000).resample('D').sum()
-    daily_df['sol_rad_agri'] = (df_env['avg_ghi_agrivoltaic'] * 3600 / 1_000_000).resample('D').sum()
-
-    et_open_field = pyet.pm(tmean=daily_df['tmean'], wind=daily_df['wind'], rs=daily_df['sol_rad_open'], elevation=system_params['altitude'], lat=system_params['latitude'], tmax=daily_df['tmax'], tmin=daily_df['tmin'], rh=daily_df['rh'])
-    et_agrivoltaic = pyet.pm(tmean=daily_df['tmean'], wind=daily_df['wind'], rs=daily_df['sol_rad_agri'], elevation=system_params['altitude'], lat=system_params['latitude'], tmax=daily_df['tmax'], tmin=daily_df['tmin'], rh=daily_df['rh'])
-    
     total_et_open_field = et_open_field.sum()
-    total_et_agrivoltaic = et_agrivoltaic.sum()
+    total_et_agrivoltaic = np.array([et.sum() for et in et_agrivoltaic])
+    if total_et_open_field > 0:
+        water_savings_percent = (total_et_open_field - total_et_agrivoltaic) / total_et_open_field * 100
+    else:
+        water_savings_percent = np.zeros(len(pitches))
+
+    return {
+        'pitches': pitches,
+        'panel_tilt': geometry['panel_tilt'],
+        'avg_ghi_agrivoltaic': avg_ghi_agrivoltaic,
+        'et_open': et_open_field,
+        'et_agri': et_agrivoltaic,
+        'total_et_open': total_et_open_field,
+        'total_et_agri': total_et_agrivoltaic,
+        'water_savings': water_savings_percent
+    }
+
+def _simulation_frame(env, panel_tilt, avg_ghi_agrivoltaic):
+    """df_sim of one pitch: the weather plus the pitch's columns, sharing the weather arrays."""
+    return env.with_columns(panel_tilt=panel_tilt, avg_ghi_agrivoltaic=avg_ghi_agrivoltaic,
+                            temp_agrivoltaic=np.asarray(env['temp_air'], dtype=float) - 1.2)
 
-    water_savings_percent = ((total_et_open_field - total_et_agrivoltaic) / total_et_open_field) * 100 if total_et_open_field > 0 else 0
+def _pitch_outputs(df_env, sweep, i):
+    """Unpacks pitch i of a sweep into the tuple returned by _run_shading_and_et_simulation."""
+    df_sim = _simulation_frame(env_arrays.as_env(df_env), sweep['panel_tilt'][i], sweep['avg_ghi_agrivoltaic'][i])
+    return (df_sim, sweep['water_savings'][i], sweep['total_et_open'], sweep['total_et_agri'][i],
+            sweep['et_open'], sweep['et_agri'][i])
 
-    return df_env, water_savings_percent, total_et_open_field, total_et_agrivoltaic, et_open_field, et_agrivoltaic
+def _run_shading_and_et_simulation(df_env, system_params, pitch, ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    env = env_arrays.as_env(df_env)
+    sweep = _simulate_pitches(env, system_params, [pitch], ground_resolution, shading_method, progress)
+    return _pitch_outputs(env, sweep, 0)
+
+def _june_21(df_sim):
+    calendar = df_sim.calendar()
+    return (calendar['month'] == 6) & (calendar['day'] == 21)
+
+def _daily_light_integral(ghi):
+    ppfd = -46.65 + 1.792 * np.clip(np.asarray(ghi, dtype=float), 0, None)
+    return (np.clip(ppfd, 0, None) * 3600).sum() / 1_000_000
 
 def _calculate_crop_metrics(df_sim):
-    june_21_data = df_sim[df_sim.index.strftime('%m-%d') == '06-21']
-    ppfd_open = -46.65 + 1.792 * june_21_data['ghi'].clip(lower=0)
-    dli_open = (ppfd_open.clip(lower=0) * 3600).sum() / 1_000_000
-    ppfd_agrivoltaic = -46.65 + 1.792 * june_21_data['avg_ghi_agrivoltaic'].clip(lower=0)
-    dli_agrivoltaic = (ppfd_agrivoltaic.clip(lower=0) * 3600).sum() / 1_000_000
-
-    df_sim['temp_agrivoltaic'] = df_sim['temp_air'] - 1.2
-    summer_months = df_sim[df_sim.index.month.isin([6, 7, 8])]
-    peak_temp_open = summer_months['temp_air'].max()
-    peak_temp_agri = summer_months['temp_agrivoltaic'].max()
+    june_21 = _june_21(df_sim)
+    dli_open = _daily_light_integral(df_sim['ghi'][june_21])
+    dli_agrivoltaic = _daily_light_integral(df_sim['avg_ghi_agrivoltaic'][june_21])
+
+    summer_months = np.isin(df_sim.calendar()['month'], [6, 7, 8])
+    peak_temp_open = float(df_sim['temp_air'][summer_months].max()) if summer_months.any() else np.nan
+    peak_temp_agri = float(df_sim['temp_agrivoltaic'][summer_months].max()) if summer_months.any() else np.nan
     
     return dli_open, dli_agrivoltaic, peak_temp_open, peak_temp_agri
 
+def _float32_list(values):
+    # Shortest repr of each float32, so 23.1 stays 23.1 in the JSON rather than 23.100000381469727
+    return [float(str(value)) for value in values]
+
 # --- [MODIFIED v1.1] ---
 # Mab9inach kanressmo, wellina kanwejjdo data l'JavaScript
 def _prepare_graph_data(data_dict, pitch):
     graph_data = {}
 
     # --- Graph 1: Summer Solstice Irradiance ---
-    june_21_data = data_dict['df_sim'][data_dict['df_sim'].index.strftime('%m-%d') == '06-21']
+    df_sim = data_dict['df_sim']
+    june_21 = _june_21(df_sim)
     graph_data['irradiance'] = {
-        'labels': june_21_data.index.strftime('%H:%M').tolist(),
+        'labels': df_sim.index[june_21].strftime('%H:%M').tolist(),
         'datasets': [
             # [MODIFIED] Using label_key instead of hardcoded label
-            {'label_key': 'graph_legend_open_field_ghi', 'data': june_21_data['ghi'].tolist(), 'borderColor': 'orange', 'tension': 0.1},
-            {'label_key': 'graph_legend_agri_ghi', 'data': june_21_data['avg_ghi_agrivoltaic'].tolist(), 'borderColor': 'brown', 'tension': 0.1, 'pitch': pitch}
+            {'label_key': 'graph_legend_open_field_ghi', 'data': _float32_list(df_sim['ghi'][june_21]), 'borderColor': 'orange', 'tension': 0.1},
+            {'label_key': 'graph_legend_agri_ghi', 'data': _float32_list(df_sim['avg_ghi_agrivoltaic'][june_21]), 'borderColor': 'brown', 'tension': 0.1, 'pitch': pitch}
         ]
     }
 
@@ -139,16 +421,19 @@ def _prepare_graph_data(data_dict, pitch):
     }
     
     # --- Graph 4: Temperature on Hottest Day ---
-    hottest_day = data_dict['df_sim']['temp_air'].idxmax().date()
-    hottest_day_data = data_dict['df_sim'][data_dict['df_sim'].index.date == hottest_day]
+    day_start = df_sim.calendar()['day_start']
+    hottest_hour = int(np.nanargmax(df_sim['temp_air']))
+    day = np.searchsorted(day_start, hottest_hour, side='right') - 1
+    hottest_day_rows = slice(day_start[day], day_start[day + 1] if day + 1 < len(day_start) else len(df_sim))
+    hottest_day = df_sim.index[hottest_hour].date()
     graph_data['peak_temp'] = {
         # [MODIFIED] Returning a key and the date separately
         'title_key': 'graph_title_peak_temp_on_date',
         'title_date': hottest_day.strftime("%B %d"),
-        'labels': hottest_day_data.index.strftime('%H:%M').tolist(),
+        'labels': df_sim.index[hottest_day_rows].strftime('%H:%M').tolist(),
         'datasets': [
-            {'label_key': 'graph_legend_open_field_temp', 'data': hottest_day_data['temp_air'].tolist(), 'borderColor': 'red', 'tension': 0.1},
-            {'label_key': 'graph_legend_agri_temp', 'data': hottest_day_data['temp_agrivoltaic'].tolist(), 'borderColor': 'green', 'tension': 0.1, 'borderDash': [5, 5]}
+            {'label_key': 'graph_legend_open_field_temp', 'data': _float32_list(df_sim['temp_air'][hottest_day_rows]), 'borderColor': 'red', 'tension': 0.1},
+            {'label_key': 'graph_legend_agri_temp', 'data': _float32_list(df_sim['temp_agrivoltaic'][hottest_day_rows]), 'borderColor': 'green', 'tension': 0.1, 'borderDash': [5, 5]}
         ]
     }
     
@@ -156,34 +441,44 @@ def _prepare_graph_data(data_dict, pitch):
 
 
 
-def run_single_pitch_analysis(df_env_base, system_params, crop_params, pitch):
-    df_sim, water_savings, et_open, et_agri, et_open_series, et_agri_series = _run_shading_and_et_simulation(df_env_base.copy(), system_params, pitch)
+def _pitch_results(simulation_outputs):
+    df_sim, water_savings, et_open, et_agri, _, _ = simulation_outputs
     dli_open, dli_agri, peak_temp_open, peak_temp_agri = _calculate_crop_metrics(df_sim)
 
-    results = {
+    return {
         "water_savings": water_savings, "et_open": et_open, "et_agri": et_agri,
         "dli_open": dli_open, "dli_agri": dli_agri,
         "peak_temp_open": peak_temp_open, "peak_temp_agri": peak_temp_agri
     }
+
+def _summarize_pitch(simulation_outputs, pitch, progress=None):
+    df_sim, _, _, _, et_open_series, et_agri_series = simulation_outputs
+    with metrics.timed('results'):
+        results = _pitch_results(simulation_outputs)
+    _report_progress(progress, 'metrics')
     
     # [MODIFIED v1.1] Kanwejjdo data dyal l'graph, ماشي les images
     plot_data_for_js = {'df_sim': df_sim, 'et_open': et_open_series, 'et_agri': et_agri_series}
-    graph_data = _prepare_graph_data(plot_data_for_js, pitch)
+    with metrics.timed('graphs'):
+        graph_data = _prepare_graph_data(plot_data_for_js, pitch)
+    _report_progress(progress, 'graphs')
     
     return results, graph_data
 
-def run_optimization_analysis(df_env_base, system_params, crop_params):
+def run_single_pitch_analysis(df_env_base, system_params, crop_params, pitch, ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    simulation_outputs = _run_shading_and_et_simulation(df_env_base, system_params, pitch, ground_resolution, shading_method, progress)
+    return _summarize_pitch(simulation_outputs, pitch, progress)
+
+# --- [MODIFIED v1.3] ---
+# L'pitches kamlin f sweep wa7ed, o l'optimal pitch ma kay3awdch yetsimula: resultats dyalo kayrj3o m3a l'optimization
+def run_optimization_analysis(df_env_base, system_params, crop_params, ground_resolution=DEFAULT_GROUND_RESOLUTION, shading_method='raster', progress=None):
+    env = env_arrays.as_env(df_env_base)
     pitch_options = np.arange(4.0, 10.5, 0.5)
-    results_list = []
+    sweep = _simulate_pitches(env, system_params, pitch_options, ground_resolution, shading_method, progress)
 
-    for pitch in pitch_options:
-        _, water_savings, _, _, _, _ = _run_shading_and_et_simulation(df_env_base.copy(), system_params, pitch)
-        results_list.append({
-            'pitch': pitch,
-            'water_savings_percent': water_savings
-        })
-    results_df = pd.DataFrame(results_list)
-    optimal_pitch_data = results_df.loc[results_df['water_savings_percent'].idxmax()]
+    results_df = pd.DataFrame({'pitch': pitch_options, 'water_savings_percent': sweep['water_savings']})
+    optimal_index = results_df['water_savings_percent'].idxmax()
+    optimal_pitch_data = results_df.loc[optimal_index]
 
     # [MODIFIED v1.1] Kanwejjdo data dyal l'graph dyal l'optimization
     graph_data = {
@@ -198,7 +493,61 @@ def run_optimization_analysis(df_env_base, system_params, crop_params):
     }
     
     # Kanwejjdo hta les graphs l'okhrin dyal l'optimal pitch
-    _ , single_pitch_graph_data = run_single_pitch_analysis(df_env_base, system_params, crop_params, optimal_pitch_data['pitch'])
+    simulation_outputs = _pitch_outputs(env, sweep, optimal_index)
+    single_pitch_results, single_pitch_graph_data = _summarize_pitch(simulation_outputs, optimal_pitch_data['pitch'], progress)
     graph_data.update(single_pitch_graph_data)
-    
-    return optimal_pitch_data.to_dict(), graph_data
+
+    optimal_results = dict(single_pitch_results)
+    optimal_results.update(optimal_pitch_data.to_dict())
+    return optimal_results, graph_data
+
+def compare_shading_methods(df_env_base, system_params, pitch, ground_resolution=DEFAULT_GROUND_RESOLUTION):
+    """Runs the raster and analytic shading paths side by side, for validation and timing."""
+    env = env_arrays.as_env(df_env_base)
+    comparison = {}
+    for method in SHADING_METHODS:
+        start_time = time.perf_counter()
+        df_sim, water_savings, _, _, _, _ = _run_shading_and_et_simulation(env, system_params, pitch, ground_resolution, method)
+        comparison[method] = {
+            'runtime_s': time.perf_counter() - start_time,
+            'water_savings': water_savings,
+            'avg_ghi_agrivoltaic': np.asarray(df_sim['avg_ghi_agrivoltaic'], dtype=float)
+        }
+    ghi_diff = comparison['analytic']['avg_ghi_agrivoltaic'] - comparison['raster']['avg_ghi_agrivoltaic']
+    comparison['max_abs_ghi_diff'] = float(np.abs(ghi_diff).max())
+    comparison['water_savings_diff'] = comparison['analytic']['water_savings'] - comparison['raster']['water_savings']
+    return comparison
+
+def compare_et_with_pyet(df_env_base, system_params, pitches=None, ground_resolution=DEFAULT_GROUND_RESOLUTION, repeat=3):
+    """Checks the vectorized ET against pyet.pm on a pitch sweep and times both, for validation."""
+    env = env_arrays.as_env(df_env_base)
+    pitches = np.arange(4.0, 10.5, 0.5) if pitches is None else np.atleast_1d(np.asarray(pitches, dtype=float))
+    sweep = _simulate_pitches(env, system_params, pitches, ground_resolution)
+    daily_df = _aggregate_daily_weather(env)
+    sol_rad = pd.DataFrame(env.daily(sweep['avg_ghi_agrivoltaic'] * 3600 / 1_000_000).T, index=daily_df.index)
+    sol_rad.insert(0, 'open', daily_df['sol_rad_open'])
+
+    def run_pyet():
+        return np.column_stack([
+            pyet.pm(tmean=daily_df['tmean'], wind=daily_df['wind'], rs=sol_rad[column], elevation=system_params['altitude'],
+                    lat=system_params['latitude'], tmax=daily_df['tmax'], tmin=daily_df['tmin'], rh=daily_df['rh']).to_numpy()
+            for column in sol_rad.columns
+        ])
+
+    def run_vectorized():
+        return _penman_monteith_matrix(_penman_monteith_terms(daily_df, system_params), sol_rad.to_numpy())
+
+    timings = {}
+    for name, function in (('pyet', run_pyet), ('vectorized', run_vectorized)):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            et = function()
+        timings[name] = (time.perf_counter() - start_time) / repeat
+        timings[name + '_et'] = et
+    return {
+        'scenarios': sol_rad.shape[1],
+        'pyet_runtime_s': timings['pyet'],
+        'vectorized_runtime_s': timings['vectorized'],
+        'speedup': timings['pyet'] / timings['vectorized'],
+        'max_abs_et_diff': float(np.nanmax(np.abs(timings['vectorized_et'] - timings['pyet_et'])))
+    }
@@ -0,0 +1,101 @@
+# solar_geometry.py (v1.0)
+# Sun position o tracker tilt ma kaytbeddlouch m3a l'weather wla l'crop, so kanhfdohom f cache m7doud (LRU).
+
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pvlib
+
+SOLAR_POSITION_CACHE_SIZE = 64
+TRACKER_CACHE_SIZE = 512
+
+
+class _LRUCache:
+    """Small thread-safe LRU with hit/miss counters."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        # Computed outside the lock; two threads racing on one key just both compute it
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+_solar_position_cache = _LRUCache(SOLAR_POSITION_CACHE_SIZE)
+_tracker_cache = _LRUCache(TRACKER_CACHE_SIZE)
+
+
+def _read_only(values):
+    array = np.array(values, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+def hourly_index(year):
+    return pd.date_range(start=f'{year}-01-01 00:00', end=f'{year}-12-31 23:00', freq='h', tz='Etc/GMT')
+
+
+def solar_position(latitude, longitude, altitude, year):
+    """Hourly sun elevation and azimuth (degrees) for a whole year, as read-only arrays.
+
+    This is the true (unrefracted) elevation, so the air temperature passed by the weather
+    never changes it and one entry serves every weather series of a site.
+    """
+    key = (float(latitude), float(longitude), float(altitude), int(year))
+
+    def compute():
+        position = pvlib.solarposition.get_solarposition(hourly_index(year), latitude, longitude, altitude=altitude)
+        return _read_only(position['elevation']), _read_only(position['azimuth'])
+
+    return _solar_position_cache.get_or_compute(key, compute)
+
+
+def tracker_tilt(latitude, longitude, altitude, year, axis_azimuth, max_tilt, gcr):
+    """Hourly backtracking single-axis tracker tilt (degrees, 0 at night), as a read-only array."""
+    key = (float(latitude), float(longitude), float(altitude), int(year), float(axis_azimuth), float(max_tilt), round(float(gcr), 9))
+
+    def compute():
+        sun_elevation, sun_azimuth = solar_position(latitude, longitude, altitude, year)
+        tracking_data = pvlib.tracking.singleaxis(
+            90 - sun_elevation, sun_azimuth,
+            axis_azimuth=axis_azimuth, max_angle=max_tilt,
+            backtrack=True, gcr=gcr
+        )
+        return _read_only(np.nan_to_num(np.asarray(tracking_data['surface_tilt'], dtype=float), nan=0.0))
+
+    return _tracker_cache.get_or_compute(key, compute)
+
+
+def cache_info():
+    return {'solar_position': _solar_position_cache.info(), 'tracker': _tracker_cache.info()}
+
+
+def clear_caches():
+    _solar_position_cache.clear()
+    _tracker_cache.clear()
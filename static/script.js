@@ -52,9 +52,14 @@ document.addEventListener('DOMContentLoaded', () => {
     const loadingIndicator = document.getElementById('loading_indicator');
     const resultsDashboard = document.getElementById('results_dashboard');
     const errorMessageDiv = document.getElementById('error_message');
+    const loadingText = document.getElementById('loading_text');
 
     let currentLanguageStrings = {};
     let activeCharts = {};
+    let currentJob = null;
+    let simulationRunId = 0;
+    // Last response (and its ETag) per set of inputs, revalidated instead of re-downloaded
+    const cachedResponses = new Map();
 
     // --- Event Listeners ---
     runBtn.addEventListener('click', runSimulation);
@@ -145,27 +150,183 @@ document.addEventListener('DOMContentLoaded', () => {
 
         destroyActiveCharts();
 
-        try {
-            const response = await fetch('/simulate', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(inputs),
-            });
+        cancelCurrentJob();
+        const runId = ++simulationRunId;
+        showProgress({ stage: 'running' });
 
-            const data = await response.json();
+        try {
+            const data = await runSimulationJob(inputs);
+            if (runId !== simulationRunId) return; // Superseded by a newer run
 
-            if (!response.ok) {
-                throw new Error(data.error || 'Unknown error occurred.');
-            }
-            
             displayResults(data, inputs);
             
         } catch (error) {
+            if (runId !== simulationRunId) return;
             console.error('Simulation failed:', error);
             displayError(`Simulation failed: ${error.message}`);
         } finally {
-            loadingIndicator.style.display = 'none';
+            if (runId === simulationRunId) loadingIndicator.style.display = 'none';
+        }
+    }
+
+    // --- [MODIFIED v1.4] Job API: the simulation runs in the background and reports its progress ---
+    async function runSimulationJob(inputs) {
+        const cacheKey = JSON.stringify(inputs);
+        const cached = cachedResponses.get(cacheKey);
+        const headers = { 'Content-Type': 'application/json' };
+        if (cached) headers['If-None-Match'] = cached.etag;
+
+        const submitResponse = await fetch('/simulate/jobs' + GRAPH_FORMAT_QUERY, {
+            method: 'POST',
+            headers: headers,
+            body: cacheKey,
+        });
+        if (submitResponse.status === 304 && cached) {
+            return structuredClone(cached.data);
+        }
+        if (submitResponse.status === 404) {
+            return runBlockingSimulation(inputs);
+        }
+        const job = await submitResponse.json();
+        if (!submitResponse.ok) {
+            throw new Error(job.error || 'Unknown error occurred.');
+        }
+        currentJob = job;
+
+        await waitForJob(job);
+        if (currentJob !== job) return null;
+        currentJob = null;
+
+        const response = await fetch(job.result_url + GRAPH_FORMAT_QUERY);
+        const data = decodeGraphData(await response.json());
+        if (!response.ok) {
+            throw new Error(data.error || 'Unknown error occurred.');
+        }
+        const etag = response.headers.get('ETag');
+        if (etag) {
+            // displayResults mutates the graph datasets, so keep a pristine copy
+            cachedResponses.set(cacheKey, { etag: etag, data: structuredClone(data) });
+        }
+        return data;
+    }
+
+    async function runBlockingSimulation(inputs) {
+        const response = await fetch('/simulate' + GRAPH_FORMAT_QUERY, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(inputs),
+        });
+
+        const data = decodeGraphData(await response.json());
+
+        if (!response.ok) {
+            throw new Error(data.error || 'Unknown error occurred.');
+        }
+        return data;
+    }
+
+    // --- [MODIFIED v1.5] Compact graph payload: float32 series and start+step labels (see graph_payload.py) ---
+    const GRAPH_FORMAT_QUERY = '?graph_format=compact';
+
+    function decodeFloat32(base64) {
+        const bytes = Uint8Array.from(atob(base64), c => c.charCodeAt(0));
+        return new Float32Array(bytes.buffer);
+    }
+
+    function decodeLabels(labels) {
+        if (!labels || Array.isArray(labels)) return labels;
+        const indices = Array.from({ length: labels.count }, (_, i) => i);
+        switch (labels.kind) {
+            case 'range':
+                return indices.map(i => labels.start + i * labels.step);
+            case 'float32':
+                return Array.from(decodeFloat32(labels.base64));
+            case 'dates': {
+                const start = Date.parse(`${labels.start}T00:00:00Z`);
+                return indices.map(i => new Date(start + i * labels.step_days * 86400000).toISOString().slice(0, 10));
+            }
+            case 'times':
+                return indices.map(i => {
+                    const minute = labels.start_minutes + i * labels.step_minutes;
+                    return `${String(Math.floor(minute / 60) % 24).padStart(2, '0')}:${String(minute % 60).padStart(2, '0')}`;
+                });
+            default:
+                return labels;
+        }
+    }
+
+    function decodeDatasetData(data) {
+        if (!data || data.dtype !== 'float32') return data;
+        const values = decodeFloat32(data.base64);
+        if (data.shape.length === 2) {
+            return Array.from({ length: data.shape[0] }, (_, i) => ({ x: values[2 * i], y: values[2 * i + 1] }));
+        }
+        return Array.from(values);
+    }
+
+    function decodeGraphData(data) {
+        if (!data || data.graph_encoding !== 'compact/1' || !data.graph_data) return data;
+        for (const graph of Object.values(data.graph_data)) {
+            if (!graph || typeof graph !== 'object') continue;
+            if ('labels' in graph) graph.labels = decodeLabels(graph.labels);
+            (graph.datasets || []).forEach(dataset => { dataset.data = decodeDatasetData(dataset.data); });
+        }
+        delete data.graph_encoding;
+        return data;
+    }
+
+    function waitForJob(job) {
+        if (typeof EventSource === 'undefined') {
+            return pollJob(job);
+        }
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(job.events_url);
+            job.stopWaiting = () => {
+                source.close();
+                resolve();
+            };
+            source.addEventListener('progress', (e) => showProgress(JSON.parse(e.data)));
+            source.addEventListener('done', () => {
+                source.close();
+                resolve();
+            });
+            source.onerror = () => {
+                // The stream dropped: fall back to polling the job status
+                source.close();
+                pollJob(job).then(resolve, reject);
+            };
+        });
+    }
+
+    async function pollJob(job) {
+        while (currentJob === job) {
+            const response = await fetch(job.status_url);
+            const status = await response.json();
+            if (!response.ok) {
+                throw new Error(status.error || 'Unknown error occurred.');
+            }
+            if (status.status !== 'queued' && status.status !== 'running') return;
+            showProgress(status.progress || { stage: status.status });
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+
+    function cancelCurrentJob() {
+        if (!currentJob) return;
+        const job = currentJob;
+        currentJob = null;
+        fetch(job.status_url, { method: 'DELETE' }).catch(() => {});
+        if (job.stopWaiting) job.stopWaiting();
+    }
+
+    function showProgress(progress) {
+        let text = currentLanguageStrings[`progress_${progress.stage}`] || currentLanguageStrings['progress_running'] || 'Running simulation, please wait...';
+        if (progress.total > 1) {
+            text += ` (${progress.done}/${progress.total})`;
+        } else if (progress.stage === 'optimization' && progress.done) {
+            text += ` (${progress.done})`;
         }
+        loadingText.textContent = text;
     }
 
     function displayError(message) {
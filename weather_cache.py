@@ -0,0 +1,179 @@
+# weather_cache.py (v1.0)
+# Cache local dyal PVGIS TMY: kol site kayt7et f fichier .npz (column b column), bach ma n3awdoch l'fetch.
+#
+# Pre-seeding:  python weather_cache.py seed sites.csv      (columns: latitude,longitude,altitude)
+#               python weather_cache.py seed --site 40.99,14.25,25 --site 36.8,10.2,10
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.environ.get('AGRIVOLTAIC_WEATHER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'pvgis'))
+CACHE_TTL_SECONDS = float(os.environ.get('AGRIVOLTAIC_WEATHER_CACHE_TTL', 30 * 24 * 3600))
+CACHE_MAX_BYTES = int(os.environ.get('AGRIVOLTAIC_WEATHER_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+OFFLINE = os.environ.get('AGRIVOLTAIC_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+# 0.01° is ~1 km, finer than the PVGIS grid itself
+COORD_DECIMALS = 2
+
+
+def site_key(latitude, longitude, altitude):
+    return round(float(latitude), COORD_DECIMALS), round(float(longitude), COORD_DECIMALS), int(round(float(altitude)))
+
+
+def _cache_path(key):
+    latitude, longitude, altitude = key
+    return os.path.join(CACHE_DIR, f"{latitude:+.{COORD_DECIMALS}f}_{longitude:+.{COORD_DECIMALS}f}_{altitude}m.npz")
+
+
+def read_frame(path, max_age=None):
+    """Reads a df_env written by write_frame; None if it is missing, unreadable or older than max_age seconds."""
+    try:
+        with np.load(path, allow_pickle=False) as archive:
+            fetched_at = float(archive['__fetched_at__'])
+            if max_age is not None and time.time() - fetched_at > max_age:
+                return None
+            columns = json.loads(str(archive['__columns__']))
+            index = pd.date_range(start=pd.Timestamp(int(archive['__start__']), tz=str(archive['__tz__'])),
+                                  periods=int(archive['__periods__']), freq='h')
+            return pd.DataFrame({column: archive[column] for column in columns}, index=index)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_frame(path, df_env, compressed=False):
+    """Writes df_env column by column to an .npz, atomically, so concurrent gunicorn workers never read a partial file."""
+    arrays = {column: df_env[column].to_numpy() for column in df_env.columns}
+    arrays['__columns__'] = np.array(json.dumps(list(df_env.columns)))
+    arrays['__start__'] = np.array(df_env.index[0].value)
+    arrays['__tz__'] = np.array(str(df_env.index.tz))
+    arrays['__periods__'] = np.array(len(df_env.index))
+    arrays['__fetched_at__'] = np.array(time.time())
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npz.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            (np.savez_compressed if compressed else np.savez)(f, **arrays)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load(key, allow_stale=False):
+    """Returns the cached df_env for a site key, or None on a miss or an expired entry."""
+    path = _cache_path(key)
+    df_env = read_frame(path, max_age=None if allow_stale else CACHE_TTL_SECONDS)
+    if df_env is None:
+        return None
+    # The file's mtime doubles as its last-access time for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return df_env
+
+
+def fetched_at(key, allow_stale=False):
+    """When the cached entry of a key was fetched (its version), or None on a miss or an expired entry.
+
+    Only reads the timestamp; counts as a use of the entry, like load.
+    """
+    path = _cache_path(key)
+    try:
+        with np.load(path, allow_pickle=False) as archive:
+            stamp = float(archive['__fetched_at__'])
+    except (OSError, KeyError, ValueError):
+        return None
+    if not allow_stale and time.time() - stamp > CACHE_TTL_SECONDS:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return stamp
+
+
+def store(key, df_env):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    write_frame(_cache_path(key), df_env)
+    evict()
+
+
+def evict(max_bytes=None):
+    """Drops entries unused for a whole TTL, then the least recently used ones until the cache fits in max_bytes."""
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    try:
+        entries = [entry for entry in os.scandir(CACHE_DIR) if entry.name.endswith('.npz')]
+    except FileNotFoundError:
+        return
+    entries = [(entry.path, entry.stat()) for entry in entries]
+    now = time.time()
+    total_bytes = sum(stat.st_size for _, stat in entries)
+    for path, stat in sorted(entries, key=lambda item: item[1].st_mtime):
+        idle_too_long = now - stat.st_mtime > CACHE_TTL_SECONDS
+        if not idle_too_long and total_bytes <= max_bytes:
+            continue
+        try:
+            os.remove(path)
+            total_bytes -= stat.st_size
+        except FileNotFoundError:
+            pass
+
+
+def _read_sites(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            return [(site['latitude'], site['longitude'], site.get('altitude', 0)) for site in json.load(f)]
+    sites = pd.read_csv(path)
+    altitudes = sites['altitude'] if 'altitude' in sites else [0] * len(sites)
+    return list(zip(sites['latitude'], sites['longitude'], altitudes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the local PVGIS weather cache.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    seed_parser = subparsers.add_parser('seed', help="Fetch and cache the TMY of a list of sites.")
+    seed_parser.add_argument('sites_file', nargs='?', help="CSV or JSON list of sites (latitude, longitude, altitude).")
+    seed_parser.add_argument('--site', action='append', default=[], help="A single site as lat,lon[,alt].")
+    seed_parser.add_argument('--refresh', action='store_true', help="Re-fetch sites that are already cached.")
+    subparsers.add_parser('evict', help="Apply the TTL and size limits now.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'evict':
+        evict()
+        return 0
+
+    import simulation_core as core
+
+    sites = _read_sites(args.sites_file) if args.sites_file else []
+    for site in args.site:
+        values = [float(value) for value in site.split(',')]
+        sites.append((values[0], values[1], values[2] if len(values) > 2 else 0))
+
+    failures = 0
+    for latitude, longitude, altitude in sites:
+        key = site_key(latitude, longitude, altitude)
+        if not args.refresh and load(key) is not None:
+            print(f"cached   {key}")
+            continue
+        # The old entry stays in place until the new one replaces it (write_frame is atomic),
+        # so a failed refresh leaves the site cached for offline use
+        previous = fetched_at(key, allow_stale=True)
+        df_env = core.fetch_pvgis_data(latitude, longitude, altitude, offline=False, refresh=args.refresh)
+        if df_env is None or (previous is not None and fetched_at(key, allow_stale=True) == previous):
+            failures += 1
+            print(f"FAILED   {key}" + (" (cached copy kept)" if previous is not None else ""))
+        else:
+            print(f"fetched  {key}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())